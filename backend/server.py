@@ -1,19 +1,239 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Body, Depends, File, Header, UploadFile, WebSocket, WebSocketDisconnect, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional, Dict, Any, Set
+from datetime import datetime, timezone, timedelta
 import motor.motor_asyncio
+from bson import ObjectId, json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo import ASCENDING, DESCENDING, CursorType, IndexModel, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+import asyncio
+import logging
 import os
+import sys
 from dotenv import load_dotenv
+import orjson
+
+try:
+    import brotli
+except ImportError:  # optional, responses fall back to gzip
+    brotli = None
 import uuid
 import base64
+import binascii
+import hashlib
 import json
+import bisect
+import csv
+import io
+import gzip
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from itertools import islice
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
-app = FastAPI(title="Grassroots Match Tracker API", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+def dump_json(content: Any) -> bytes:
+    # orjson writes datetimes as ISO 8601; default=str covers ObjectId and friends
+    return orjson.dumps(content, default=str)
+
+def dump_json_object(fields: Dict[str, Any]) -> bytes:
+    # bytes values are treated as already-serialized JSON and embedded as is,
+    # so a document encoded once can be reused in several messages
+    parts = [
+        dump_json(key) + b":" + (value if isinstance(value, bytes) else dump_json(value))
+        for key, value in fields.items()
+    ]
+    return b"{" + b",".join(parts) + b"}"
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+# Documents this API wrote itself are returned without being validated again
+# against the response model. Set TRUSTED_OUTPUT=0 to always validate.
+TRUSTED_OUTPUT = os.getenv("TRUSTED_OUTPUT", "1") == "1"
+
+def trusted_response(content: Any, headers: Optional[Dict[str, str]] = None):
+    if TRUSTED_OUTPUT:
+        return FastJSONResponse(content=content, headers=headers)
+    return content
+
+# Metrics, exposed at /metrics in the Prometheus text format. Labels are
+# route templates, collections and command names so cardinality stays flat.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS: List["Metric"] = []
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+    
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        # pymongo calls command listeners from its own threads
+        self.lock = threading.Lock()
+        METRICS.append(self)
+    
+    def samples(self):
+        return []
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[tuple, float] = {}
+    
+    def inc(self, *labels, amount: float = 1.0):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+    
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [("", self.labels, labels, value) for labels, value in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+    
+    def __init__(self, name: str, documentation: str, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+    
+    def dec(self, *labels, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+    
+    def set(self, *labels, value: float):
+        with self.lock:
+            self.values[labels] = value
+    
+    def samples(self):
+        if self.function is not None:
+            return [("", (), (), self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket plus +Inf, then the running sum
+        self.values: Dict[tuple, List[float]] = {}
+    
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 2)
+            row[index] += 1
+            row[-1] += value
+    
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(row)) for labels, row in self.values.items()]
+        names = self.labels + ("le",)
+        result = []
+        for labels, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row[:-1]):
+                cumulative += count
+                result.append(("_bucket", names, labels + ("+Inf" if bound == float("inf") else str(bound),), cumulative))
+            result.append(("_sum", self.labels, labels, row[-1]))
+            result.append(("_count", self.labels, labels, cumulative))
+        return result
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+http_requests_total = Counter("http_requests_total", "HTTP requests by route and status.",
+                              ("method", "route", "status"))
+http_request_seconds = Histogram("http_request_duration_seconds", "HTTP request latency until the last body chunk.",
+                                 ("method", "route"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served.", ("method",))
+websocket_connections = Gauge("websocket_connections", "Open WebSocket connections.",
+                              function=lambda: len(manager.active_connections))
+broadcast_fanout_seconds = Histogram("websocket_broadcast_fanout_seconds",
+                                     "Time to queue one broadcast for every subscriber.")
+broadcast_recipients = Histogram("websocket_broadcast_recipients", "Subscribers reached per broadcast.",
+                                 buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000))
+mongo_command_seconds = Histogram("mongo_command_duration_seconds", "MongoDB command latency.",
+                                  ("collection", "command"))
+mongo_command_failures = Counter("mongo_command_failures_total", "Failed MongoDB commands.",
+                                 ("collection", "command"))
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = [500]
+        
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        http_requests_in_flight.inc(method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(method)
+            # The router stores the matched route in the scope; unknown paths
+            # share one label instead of one series each
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            http_request_seconds.observe(time.perf_counter() - started, method, path)
+            http_requests_total.inc(method, path, str(status[0]))
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self.collections: Dict[tuple, str] = {}
+    
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        # getMore names its collection separately; db-level commands have none
+        collection = target if isinstance(target, str) else event.command.get("collection", "")
+        self.collections[(event.connection_id, event.request_id)] = collection
+    
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, collection, event.command_name)
+    
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        mongo_command_seconds.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_command_failures.inc(collection, event.command_name)
+
+app = FastAPI(title="Grassroots Match Tracker API", version="1.0.0", default_response_class=FastJSONResponse)
 
 # CORS middleware
 app.add_middleware(
@@ -22,42 +242,287 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 
-# MongoDB connection
+# Storage: mongo, or memory for an in-process store that needs no mongod
+# (single-club installs, tests, benchmarks). STORAGE_PATH makes the memory
+# store persistent by writing through to a SQLite file.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+STORAGE_PATH = os.getenv("STORAGE_PATH")
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/grassroots_tracker")
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL)
-db = client.grassroots_tracker
+if STORAGE_BACKEND == "mongo":
+    client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL, event_listeners=[MongoCommandMetrics()])
+    db = client[os.getenv("DB_NAME", "grassroots_tracker")]
+elif STORAGE_BACKEND == "memory":
+    from storage import MemoryDatabase
+    client = None
+    db = MemoryDatabase(STORAGE_PATH)
+else:
+    raise RuntimeError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}' (expected mongo or memory)")
 
 # Security
 security = HTTPBearer()
 
 # WebSocket manager for real-time features
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")  # drop_oldest or disconnect
+
+# Connections that never subscribe receive everything, as before topics existed
+ALL_TOPICS = "*"
+
+def match_topic(match_id: str) -> str:
+    return f"match:{match_id}"
+
+def team_topic(team_id: str) -> str:
+    return f"team:{team_id}"
+
+class Connection:
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.topics: Set[str] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.sender: Optional[asyncio.Task] = None
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, backend: "BroadcastBackend"):
+        self.backend = backend
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        self.subscribers: Dict[str, Set[Connection]] = {}
     
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, topics: Optional[List[str]] = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket)
+        self.active_connections[websocket] = connection
+        self.subscribe(websocket, topics or [ALL_TOPICS])
+        connection.sender = asyncio.create_task(self._send_loop(connection))
+        return connection
     
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        self._remove_topics(connection, list(connection.topics))
+        if connection.sender and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+    
+    def subscribe(self, websocket: WebSocket, topics: List[str]):
+        connection = self.active_connections[websocket]
+        if ALL_TOPICS in connection.topics and ALL_TOPICS not in topics:
+            # Subscribing to something specific opts out of the firehose
+            self._remove_topics(connection, [ALL_TOPICS])
+        for topic in topics:
+            connection.topics.add(topic)
+            self.subscribers.setdefault(topic, set()).add(connection)
+    
+    def unsubscribe(self, websocket: WebSocket, topics: List[str]):
+        self._remove_topics(self.active_connections[websocket], topics)
+    
+    def _remove_topics(self, connection: Connection, topics: List[str]):
+        for topic in topics:
+            connection.topics.discard(topic)
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.subscribers[topic]
     
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, message)
+    
+    async def broadcast(self, message: str, topics: Optional[List[str]] = None,
+                        match_id: Optional[str] = None, seq: Optional[int] = None):
+        # Goes through the backend so sockets held by other workers see it too
+        await self.backend.publish(message, topics, match_id, seq)
+    
+    def deliver(self, message: str, topics: Optional[List[str]] = None,
+                match_id: Optional[str] = None, seq: Optional[int] = None):
+        started = time.perf_counter()
+        if match_id is not None and seq is not None:
+            match_sequencer.record(match_id, seq, message)
+        # Only queues the message; per-connection senders deliver it, so a
+        # slow socket never holds up the caller or the other spectators
+        if topics is None:
+            targets = set(self.active_connections.values())
+        else:
+            targets = set(self.subscribers.get(ALL_TOPICS, ()))
+            for topic in topics:
+                targets.update(self.subscribers.get(topic, ()))
+        for connection in targets:
+            self._enqueue(connection, message)
+        broadcast_fanout_seconds.observe(time.perf_counter() - started)
+        broadcast_recipients.observe(len(targets))
+    
+    def _enqueue(self, connection: Connection, message: str):
+        try:
+            connection.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            connection.dropped += 1
+            if WS_OVERFLOW_POLICY == "disconnect":
+                self.disconnect(connection.websocket)
+                asyncio.create_task(self._close(connection.websocket))
+            else:
+                connection.queue.get_nowait()
+                connection.queue.put_nowait(message)
+    
+    async def _send_loop(self, connection: Connection):
+        try:
+            # wait_for can swallow a cancel that lands as a send completes, so
+            # the loop also stops once the connection has been dropped
+            while connection.websocket in self.active_connections:
+                message = await connection.queue.get()
+                await asyncio.wait_for(connection.websocket.send_text(message), WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Dead or stalled socket: drop it and let the client reconnect
+            self.disconnect(connection.websocket)
+            await self._close(connection.websocket)
+    
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+# Every delta published for a match gets the next number in that match's
+# sequence. Sequences live in Mongo so they survive restarts and are shared by
+# all workers; the recent deltas are kept in a ring buffer per match so a
+# reconnecting client can catch up with {"since": <last seq seen>}.
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "256"))
+WS_REPLAY_MATCHES = int(os.getenv("WS_REPLAY_MATCHES", "1000"))
+
+class MatchSequencer:
+    def __init__(self):
+        self.buffers: "OrderedDict[str, List[Any]]" = OrderedDict()
+    
+    async def next_seq(self, match_id: str) -> int:
+        counter = await db.match_sequences.find_one_and_update(
+            {"_id": match_id}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return counter["seq"]
+    
+    async def current_seq(self, match_id: str) -> int:
+        counter = await db.match_sequences.find_one({"_id": match_id})
+        return counter["seq"] if counter else 0
+    
+    def record(self, match_id: str, seq: int, message: str):
+        buffer = self.buffers.setdefault(match_id, [])
+        self.buffers.move_to_end(match_id)
+        # Deltas from concurrent requests can be delivered slightly out of order
+        bisect.insort(buffer, (seq, message))
+        if len(buffer) > WS_REPLAY_BUFFER:
+            del buffer[0]
+        while len(self.buffers) > WS_REPLAY_MATCHES:
+            self.buffers.popitem(last=False)
+    
+    def since(self, match_id: str, seq: int) -> Optional[List[str]]:
+        buffer = self.buffers.get(match_id)
+        if not buffer:
+            # Nothing recorded here (e.g. after a restart), so gaps can't be ruled out
+            return None
+        missed = [message for message_seq, message in buffer if message_seq > seq]
+        # Replay only works if every seq after the client's is still buffered
+        if len(missed) != max(buffer[-1][0] - seq, 0):
+            return None
+        return missed
+
+match_sequencer = MatchSequencer()
+
+async def publish_match_delta(match_id: str, payload: Dict[str, Any], team_ids: List[str]):
+    seq = await match_sequencer.next_seq(match_id)
+    message = dump_json_object({**payload, "match_id": match_id, "seq": seq}).decode()
+    await manager.broadcast(message, [match_topic(match_id)] + [team_topic(t) for t in team_ids], match_id, seq)
+
+# Broadcast backends fan a message out to the ConnectionManager of every
+# process. Memory is enough for a single worker; mongo relays through a
+# capped collection so any number of workers or nodes can share one bus.
+class BroadcastBackend:
+    async def start(self, manager: ConnectionManager):
+        self.manager = manager
+    
+    async def stop(self):
+        pass
+    
+    async def publish(self, message: str, topics: Optional[List[str]] = None,
+                      match_id: Optional[str] = None, seq: Optional[int] = None):
+        raise NotImplementedError
+
+class MemoryBroadcastBackend(BroadcastBackend):
+    async def publish(self, message: str, topics: Optional[List[str]] = None,
+                      match_id: Optional[str] = None, seq: Optional[int] = None):
+        self.manager.deliver(message, topics, match_id, seq)
+
+class MongoBroadcastBackend(BroadcastBackend):
+    COLLECTION = "broadcasts"
+    CAPPED_SIZE = 16 * 1024 * 1024
     
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    def __init__(self):
+        self.origin = str(uuid.uuid4())
+        self.listener: Optional[asyncio.Task] = None
+    
+    async def start(self, manager: ConnectionManager):
+        await super().start(manager)
+        try:
+            # Tailable cursors need a capped collection, but unlike change
+            # streams they also work on a standalone mongod
+            await db.create_collection(self.COLLECTION, capped=True, size=self.CAPPED_SIZE)
+        except CollectionInvalid:
+            pass
+        self.listener = asyncio.create_task(self._listen(ObjectId.from_datetime(datetime.utcnow())))
+    
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+    
+    async def publish(self, message: str, topics: Optional[List[str]] = None,
+                      match_id: Optional[str] = None, seq: Optional[int] = None):
+        # Local sockets don't wait for the round trip through Mongo
+        self.manager.deliver(message, topics, match_id, seq)
+        await db[self.COLLECTION].insert_one({
+            "origin": self.origin, "message": message, "topics": topics, "match_id": match_id, "seq": seq,
+        })
+    
+    async def _listen(self, last_id: ObjectId):
+        while True:
+            try:
+                cursor = db[self.COLLECTION].find({"_id": {"$gt": last_id}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        last_id = doc["_id"]
+                        if doc["origin"] != self.origin:
+                            self.manager.deliver(doc["message"], doc["topics"], doc.get("match_id"), doc.get("seq"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Broadcast listener error: %s", exc)
+            # A tailable cursor dies when the collection is empty; retry shortly
+            await asyncio.sleep(0.5)
 
-manager = ConnectionManager()
+BROADCAST_BACKENDS = {
+    "memory": MemoryBroadcastBackend,
+    "mongo": MongoBroadcastBackend,
+}
+
+BROADCAST_BACKEND = os.getenv("BROADCAST_BACKEND", "memory")
+if BROADCAST_BACKEND not in BROADCAST_BACKENDS:
+    raise RuntimeError(f"Unknown BROADCAST_BACKEND '{BROADCAST_BACKEND}' (expected one of {', '.join(BROADCAST_BACKENDS)})")
+if BROADCAST_BACKEND == "mongo" and STORAGE_BACKEND != "mongo":
+    raise RuntimeError("BROADCAST_BACKEND=mongo needs STORAGE_BACKEND=mongo")
+
+manager = ConnectionManager(BROADCAST_BACKENDS[BROADCAST_BACKEND]())
 
 # Pydantic Models
 class Team(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
-    logo: Optional[str] = None  # Base64 encoded image
+    logo: Optional[str] = None  # Base64 encoded image, moved to the media store on write
+    logo_hash: Optional[str] = None  # Served from /api/media/{hash}
     primary_color: str = "#000000"
     secondary_color: str = "#ffffff"
     founded_year: Optional[int] = None
@@ -70,7 +535,8 @@ class Player(BaseModel):
     name: str
     squad_number: int
     position: str  # GK, DEF, MID, FWD
-    photo: Optional[str] = None  # Base64 encoded image
+    photo: Optional[str] = None  # Base64 encoded image, moved to the media store on write
+    photo_hash: Optional[str] = None  # Served from /api/media/{hash}
     age: Optional[int] = None
     height: Optional[str] = None
     weight: Optional[str] = None
@@ -98,8 +564,39 @@ class Match(BaseModel):
     home_substitutes: List[str] = []
     away_substitutes: List[str] = []
     match_events: List[Dict[str, Any]] = []
+    version: int = 0  # Bumped on every write, for optimistic concurrency
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+MATCH_STATUSES = ["scheduled", "live", "completed", "cancelled"]
+
+# Partial updates for the live match screens. expected_version, when given,
+# makes the write fail with 409 if someone else changed the match first.
+class ScoreUpdate(BaseModel):
+    home_score: Optional[int] = Field(None, ge=0)
+    away_score: Optional[int] = Field(None, ge=0)
+    home_delta: Optional[int] = None
+    away_delta: Optional[int] = None
+    expected_version: Optional[int] = None
+
+class StatusUpdate(BaseModel):
+    status: str
+    expected_version: Optional[int] = None
+
+class LineupUpdate(BaseModel):
+    side: str  # home or away
+    lineup: Optional[List[str]] = None
+    substitutes: Optional[List[str]] = None
+    add_to_lineup: List[str] = []
+    remove_from_lineup: List[str] = []
+    add_substitutes: List[str] = []
+    remove_substitutes: List[str] = []
+    expected_version: Optional[int] = None
+
+class FormationUpdate(BaseModel):
+    side: str  # home or away
+    formation: str
+    expected_version: Optional[int] = None
+
 class MatchEvent(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     match_id: str
@@ -123,6 +620,92 @@ class PlayerStats(BaseModel):
     red_cards: int = 0
     minutes_played: int = 0
 
+# Which PlayerStats counter each event type increments
+EVENT_STAT_COUNTERS = {
+    "goal": "goals",
+    "assist": "assists",
+    "player_of_match": "player_of_match_awards",
+    "yellow_card": "yellow_cards",
+    "red_card": "red_cards",
+}
+
+STAT_FIELDS = [f for f in PlayerStats.__fields__ if f not in ("player_id", "team_id")]
+
+def event_counter_sums() -> Dict[str, Any]:
+    # $group accumulators counting each event type into its PlayerStats counter
+    return {
+        counter: {"$sum": {"$cond": [{"$eq": ["$event_type", event_type]}, 1, 0]}}
+        for event_type, counter in EVENT_STAT_COUNTERS.items()
+    }
+
+# Seasons run August to July and are identified by their starting year
+SEASON_START_MONTH = 8
+
+def season_bounds(season: int):
+    return datetime(season, SEASON_START_MONTH, 1), datetime(season + 1, SEASON_START_MONTH, 1)
+
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(30 * 24 * 3600)))
+
+# Indexes for every access path used by the routes below. Compound keys end
+# with "id" so the keyset pagination sort is fully covered.
+INDEXES = {
+    "teams": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("name", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "players": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("team_id", ASCENDING), ("squad_number", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("team_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "matches": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("match_date", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("match_date", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("home_team_id", ASCENDING), ("match_date", DESCENDING)]),
+        IndexModel([("away_team_id", ASCENDING), ("match_date", DESCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "match_events": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("match_id", ASCENDING), ("minute", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("match_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]),
+        # Event query filters: equality keys first, then the sort key and id
+        IndexModel([("player_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("player_id", ASCENDING), ("event_type", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("team_id", ASCENDING), ("event_type", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("event_type", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("timestamp", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "player_stats": [
+        IndexModel([("player_id", ASCENDING)], unique=True),
+        IndexModel([("team_id", ASCENDING)]),
+        # One descending index per leaderboard metric
+        *[IndexModel([(counter, DESCENDING), ("player_id", ASCENDING)]) for counter in EVENT_STAT_COUNTERS.values()],
+    ],
+    "media": [
+        IndexModel([("hash", ASCENDING)], unique=True),
+    ],
+    "formations": [
+        IndexModel([("name", ASCENDING)], unique=True),
+    ],
+    "jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("lease_expires", ASCENDING)]),
+        IndexModel([("finished_at", ASCENDING)], expireAfterSeconds=JOB_RETENTION_SECONDS),
+    ],
+}
+
+async def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as exc:
+            # Usually duplicate ids left over from before ids were unique;
+            # keep serving and let check-indexes report the gap.
+            logger.warning("Could not create indexes on %s: %s", collection, exc)
+
 # Formations data with comprehensive list from PFSA
 FORMATIONS = {
     "4-4-2": {
@@ -267,6 +850,522 @@ FORMATIONS = {
     }
 }
 
+# Small in-process LRU cache with per-entry expiry
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key: str, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+    
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+    
+    def delete_prefix(self, prefix: str):
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+# Read-through cache for single documents and squad lists. Each write bumps a
+# per-kind version in meta; other workers poll those versions at most every
+# CACHE_VERSION_CHECK_SECONDS and drop that kind when it moved. Set it to 0 on
+# single-worker installs to skip the extra round trips.
+CACHE_VERSION_ID = "cache_versions"
+CACHE_VERSION_CHECK_SECONDS = float(os.getenv("CACHE_VERSION_CHECK_SECONDS", "1"))
+CACHE_KIND_PREFIXES = {
+    "team": ["team:"],
+    "player": ["player:", "team_players:"],
+    "match": ["match:"],
+}
+
+class DocumentCache(TTLCache):
+    def __init__(self, maxsize: int, ttl: float, kinds: Dict[str, List[str]] = CACHE_KIND_PREFIXES):
+        super().__init__(maxsize, ttl)
+        self.kinds = kinds
+        self.versions: Dict[str, int] = {}
+        self.checked_at = 0.0
+    
+    async def validate(self):
+        if CACHE_VERSION_CHECK_SECONDS <= 0 or time.monotonic() - self.checked_at < CACHE_VERSION_CHECK_SECONDS:
+            return
+        self.checked_at = time.monotonic()
+        versions = await db.meta.find_one({"_id": CACHE_VERSION_ID}) or {}
+        for kind, prefixes in self.kinds.items():
+            if versions.get(kind, 0) != self.versions.get(kind, 0):
+                self.versions[kind] = versions.get(kind, 0)
+                for prefix in prefixes:
+                    self.delete_prefix(prefix)
+    
+    async def invalidate(self, kind: str, *keys: str):
+        for key in keys:
+            if key.endswith(":"):
+                self.delete_prefix(key)
+            else:
+                self.delete(key)
+        if CACHE_VERSION_CHECK_SECONDS > 0:
+            versions = await db.meta.find_one_and_update(
+                {"_id": CACHE_VERSION_ID}, {"$inc": {kind: 1}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            if self.versions.get(kind, 0) == versions[kind] - 1:
+                # Nobody else wrote in between, so our other entries are still good
+                self.versions[kind] = versions[kind]
+    
+    async def get_or_load(self, key: str, loader):
+        await self.validate()
+        value = self.get(key)
+        if value is None:
+            value = await loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+document_cache = DocumentCache(
+    maxsize=int(os.getenv("DOCUMENT_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("DOCUMENT_CACHE_TTL", "60")),
+)
+
+# Pagination helpers
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(doc: Dict[str, Any], sort_field: str) -> str:
+    value = doc.get(sort_field)
+    if isinstance(value, datetime):
+        payload = {"t": "datetime", "v": value.isoformat(), "id": doc["id"]}
+    else:
+        payload = {"t": "value", "v": value, "id": doc["id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = payload["v"]
+        if payload["t"] == "datetime":
+            value = datetime.fromisoformat(value)
+        return value, payload["id"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def parse_sort(sort: str, allowed: List[str]):
+    direction = -1 if sort.startswith("-") else 1
+    field = sort.lstrip("-")
+    if field not in allowed:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by '{field}'")
+    return field, direction
+
+def parse_fields(fields: Optional[str], model, sort_field: str) -> Optional[Dict[str, int]]:
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in model.__fields__]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # id and the sort key are always needed to build the next cursor
+    projection = {f: 1 for f in requested}
+    projection.update({"_id": 0, "id": 1, sort_field: 1})
+    return projection
+
+async def fetch_page(collection, query: Dict[str, Any], model, sort: str, allowed_sorts: List[str],
+                     limit: int, after: Optional[str], fields: Optional[str]):
+    sort_field, direction = parse_sort(sort, allowed_sorts)
+    if after:
+        value, last_id = decode_cursor(after)
+        op = "$gt" if direction == 1 else "$lt"
+        query = {"$and": [query, {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "id": {op: last_id}},
+        ]}]}
+
+    projection = parse_fields(fields, model, sort_field) or {"_id": 0}
+    cursor = collection.find(query, projection).sort([(sort_field, direction), ("id", direction)])
+    # Fetch one extra document to know whether another page exists
+    docs = await cursor.limit(limit + 1).to_list(length=limit + 1)
+    headers = {}
+    if len(docs) > limit:
+        docs = docs[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(docs[-1], sort_field)
+    return docs, headers
+
+def page_response(docs: List[Dict[str, Any]], headers: Dict[str, str], response: Response, fields: Optional[str]):
+    if fields or TRUSTED_OUTPUT:
+        # Partial documents can't be validated against the full model anyway
+        return FastJSONResponse(content=docs, headers=headers)
+    response.headers.update(headers)
+    return docs
+
+async def paginate(collection, query: Dict[str, Any], response: Response, model, sort: str,
+                   allowed_sorts: List[str], limit: int, after: Optional[str], fields: Optional[str]):
+    docs, headers = await fetch_page(collection, query, model, sort, allowed_sorts, limit, after, fields)
+    return page_response(docs, headers, response, fields)
+
+# Media store helpers
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+MAX_MEDIA_BYTES = int(os.getenv("MAX_MEDIA_BYTES", str(5 * 1024 * 1024)))
+
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+    b"RIFF": "image/webp",
+}
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    # The type always comes from the bytes: whatever the client declares is
+    # ignored, so nothing but an image is ever served from our origin
+    for signature, content_type in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            if content_type == "image/webp" and data[8:12] != b"WEBP":
+                return None
+            return content_type
+    return None
+
+def check_image(data: bytes) -> str:
+    if len(data) > MAX_MEDIA_BYTES:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {MAX_MEDIA_BYTES} bytes")
+    content_type = sniff_image_type(data)
+    if content_type is None:
+        raise HTTPException(status_code=415, detail="Only PNG, JPEG, GIF and WebP images are accepted")
+    return content_type
+
+def decode_image(encoded: str):
+    if encoded.startswith("data:"):
+        encoded = encoded.partition(",")[2]
+    if len(encoded) * 3 // 4 > MAX_MEDIA_BYTES + 3:
+        raise HTTPException(status_code=413, detail=f"Images are limited to {MAX_MEDIA_BYTES} bytes")
+    try:
+        data = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Image must be base64 encoded")
+    return data, check_image(data)
+
+async def store_media_bytes(data: bytes, content_type: str) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    # Content addressed, so re-uploading the same image is a no-op
+    await db.media.update_one(
+        {"hash": digest},
+        {"$setOnInsert": {"hash": digest, "content_type": content_type, "size": len(data),
+                          "data": data, "created_at": datetime.utcnow()}},
+        upsert=True,
+    )
+    return digest
+
+async def store_media(encoded: str) -> str:
+    data, content_type = decode_image(encoded)
+    return await store_media_bytes(data, content_type)
+
+async def extract_media(doc: Dict[str, Any], field: str) -> Dict[str, Any]:
+    if doc.get(field):
+        doc[f"{field}_hash"] = await store_media(doc[field])
+        doc[field] = None
+    return doc
+
+async def migrate_inline_media():
+    for collection, field in ((db.teams, "logo"), (db.players, "photo")):
+        async for doc in collection.find({field: {"$nin": [None, ""]}}, {"_id": 0, "id": 1, field: 1}):
+            try:
+                digest = await store_media(doc[field])
+            except HTTPException:
+                continue
+            await collection.update_one({"id": doc["id"]}, {"$set": {field: None, f"{field}_hash": digest}})
+
+# Representative query per route, used by the check-indexes command
+ROUTE_QUERIES = [
+    ("GET /api/teams", "teams", {}, [("name", 1), ("id", 1)]),
+    ("GET /api/teams/{id}", "teams", {"id": "x"}, None),
+    ("GET /api/teams/{id}/players", "players", {"team_id": "x"}, [("squad_number", 1), ("id", 1)]),
+    ("GET /api/players/{id}", "players", {"id": "x"}, None),
+    ("GET /api/matches", "matches", {}, [("match_date", -1), ("id", -1)]),
+    ("GET /api/matches?status=", "matches", {"status": "live"}, [("match_date", -1), ("id", -1)]),
+    ("GET /api/matches/{id}", "matches", {"id": "x"}, None),
+    ("GET /api/matches/{id}/events", "match_events", {"match_id": "x"}, [("minute", 1), ("id", 1)]),
+    ("GET /api/match-events?player_id=", "match_events", {"player_id": "x"}, [("timestamp", 1), ("id", 1)]),
+    ("GET /api/match-events?player_id=&event_type=", "match_events",
+     {"player_id": "x", "event_type": "goal"}, [("timestamp", 1), ("id", 1)]),
+    ("GET /api/match-events?team_id=&event_type=", "match_events",
+     {"team_id": "x", "event_type": "yellow_card"}, [("timestamp", 1), ("id", 1)]),
+    ("GET /api/match-events?event_type=", "match_events", {"event_type": "red_card"}, [("timestamp", 1), ("id", 1)]),
+    ("GET /api/players/{id}/stats", "player_stats", {"player_id": "x"}, None),
+    ("GET /api/teams/{id}/stats", "players", {"team_id": {"$in": ["x"]}}, None),
+    ("GET /api/teams/{id}/stats?season=", "matches", {"home_team_id": {"$in": ["x"]}}, None),
+    ("GET /api/leaderboards/goals", "player_stats", {"goals": {"$gt": 0}}, [("goals", -1), ("player_id", 1)]),
+    ("GET /api/media/{hash}", "media", {"hash": "x"}, None),
+]
+
+def plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+async def index_report() -> List[Dict[str, Any]]:
+    report = []
+    for route, collection, query, sort in ROUTE_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        report.append({
+            "route": route,
+            "collection": collection,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+    await migrate_inline_media()
+    await formation_cache.reload()
+    await manager.backend.start(manager)
+    if LIVE_MATCH_STATE == "memory":
+        await live_matches.start()
+    if EVENT_SIDE_EFFECTS == "queue":
+        await side_effects.start()
+    cascade_jobs.start()
+    orphan_sweeper.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Drain first: queued events still need their stats and broadcasts
+    await side_effects.stop()
+    await orphan_sweeper.stop()
+    await cascade_jobs.stop()
+    await manager.backend.stop()
+    await live_matches.stop()
+    if STORAGE_BACKEND == "memory":
+        db.close()
+
+# Pre-serialized responses for data that rarely changes
+FORMATION_CACHE_CONTROL = "public, max-age=3600"
+# Workers reload club formations at least this often so edits made through
+# another worker show up without a restart
+FORMATION_RELOAD_SECONDS = float(os.getenv("FORMATION_RELOAD_SECONDS", "30"))
+
+class PrecomputedJSON:
+    def __init__(self, content: Any):
+        self.body = json.dumps(content, separators=(",", ":")).encode()
+        # Weak, since the same ETag covers the identity, gzip and br encodings
+        self.etag = f'W/"{hashlib.sha256(self.body).hexdigest()[:32]}"'
+        self.gzip = gzip.compress(self.body, compresslevel=9)
+        self.brotli = brotli.compress(self.body) if brotli else None
+    
+    def response(self, request: Request, cache_control: str) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if self.etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        accept_encoding = request.headers.get("accept-encoding", "")
+        body = self.body
+        if self.brotli is not None and "br" in accept_encoding:
+            body = self.brotli
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accept_encoding:
+            body = self.gzip
+            headers["Content-Encoding"] = "gzip"
+        return Response(content=body, media_type="application/json", headers=headers)
+
+class FormationCache:
+    def __init__(self):
+        self.loaded_at = 0.0
+        self.build({})
+    
+    def build(self, custom: Dict[str, Dict[str, Any]]):
+        formations = {**FORMATIONS, **custom}
+        self.all = PrecomputedJSON(formations)
+        self.by_name = {name: PrecomputedJSON(formation) for name, formation in formations.items()}
+    
+    async def reload(self):
+        custom = {
+            doc["name"]: doc
+            async for doc in db.formations.find({}, {"_id": 0, "name": 1, "positions": 1})
+        }
+        self.build(custom)
+        self.loaded_at = time.monotonic()
+    
+    async def response(self, name: Optional[str], request: Request) -> Response:
+        if time.monotonic() - self.loaded_at > FORMATION_RELOAD_SECONDS:
+            await self.reload()
+        payload = self.all if name is None else self.by_name.get(name)
+        if payload is None:
+            raise HTTPException(status_code=404, detail="Formation not found")
+        return payload.response(request, FORMATION_CACHE_CONTROL)
+
+# Built-in formations are serialized once at import
+formation_cache = FormationCache()
+
+# Live match state. While a match is live this process holds the
+# authoritative match document and its events in memory: reads never touch
+# Mongo, match updates are applied in memory and written back in one
+# coalesced $set every LIVE_FLUSH_INTERVAL seconds (and immediately at full
+# time). Events themselves are still inserted synchronously so they stay
+# durable and idempotent. The state is per process, so it is off by default
+# when BROADCAST_BACKEND=mongo says several workers share the writes, and
+# turning it on there is refused.
+LIVE_MATCH_STATE = os.getenv("LIVE_MATCH_STATE", "memory" if BROADCAST_BACKEND == "memory" else "off")
+if LIVE_MATCH_STATE not in ("memory", "off"):
+    raise RuntimeError(f"Unknown LIVE_MATCH_STATE '{LIVE_MATCH_STATE}' (expected memory or off)")
+if LIVE_MATCH_STATE == "memory" and BROADCAST_BACKEND != "memory":
+    raise RuntimeError("LIVE_MATCH_STATE=memory holds match state per process; use it with BROADCAST_BACKEND=memory")
+LIVE_FLUSH_INTERVAL = float(os.getenv("LIVE_FLUSH_INTERVAL", "2"))
+
+def updated_fields(update: Dict[str, Any]) -> Set[str]:
+    return {field for operator in update.values() for field in operator}
+
+def apply_update_in_memory(doc: Dict[str, Any], update: Dict[str, Any]) -> Set[str]:
+    # Supports the operators apply_match_update issues; returns changed fields
+    for field, value in update.get("$set", {}).items():
+        doc[field] = value
+    for field, value in update.get("$inc", {}).items():
+        doc[field] = (doc.get(field) or 0) + value
+    for field, value in update.get("$addToSet", {}).items():
+        items = doc.setdefault(field, [])
+        for item in value["$each"]:
+            if item not in items:
+                items.append(item)
+    for field, value in update.get("$pull", {}).items():
+        doc[field] = [item for item in doc.get(field, []) if item not in value["$in"]]
+    return updated_fields(update)
+
+def check_minimums(match: Dict[str, Any], minimums: Dict[str, int]):
+    low = [field for field, minimum in minimums.items() if (match.get(field) or 0) < minimum]
+    if low:
+        raise HTTPException(status_code=422, detail=f"{', '.join(low)} can't go below zero")
+
+class LiveMatch:
+    def __init__(self, match: Dict[str, Any], events: List[Dict[str, Any]]):
+        self.match = match
+        self.events = events
+        self.dirty: Set[str] = set()
+
+class LiveMatchRegistry:
+    def __init__(self):
+        self.matches: Dict[str, LiveMatch] = {}
+        self.flusher: Optional[asyncio.Task] = None
+    
+    def get(self, match_id: str) -> Optional[LiveMatch]:
+        return self.matches.get(match_id)
+    
+    async def track(self, match: Dict[str, Any]):
+        match.pop("_id", None)
+        events = await db.match_events.find({"match_id": match["id"]}, {"_id": 0}).to_list(length=None)
+        self.matches[match["id"]] = LiveMatch(match, events)
+    
+    async def start(self):
+        # Rehydrate whatever was live when the process last stopped
+        async for match in db.matches.find({"status": "live"}, {"_id": 0}):
+            await self.track(match)
+        self.flusher = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        if self.flusher:
+            self.flusher.cancel()
+        await self.flush()
+    
+    def add_events(self, events: List[Dict[str, Any]]):
+        for event in events:
+            live = self.matches.get(event["match_id"])
+            if live is not None:
+                live.events.append({k: v for k, v in event.items() if k != "_id"})
+    
+    def update(self, match_id: str, update: Dict[str, Any], expected_version: Optional[int],
+               minimums: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        live = self.matches[match_id]
+        if expected_version is not None and (live.match.get("version") or 0) != expected_version:
+            raise HTTPException(status_code=409, detail="Match was modified by someone else")
+        check_minimums(live.match, minimums or {})
+        live.dirty |= apply_update_in_memory(live.match, update)
+        return dict(live.match)
+    
+    async def finish(self, match_id: str):
+        await self.flush(match_id)
+        self.matches.pop(match_id, None)
+    
+    async def flush(self, match_id: Optional[str] = None):
+        targets = [match_id] if match_id else list(self.matches)
+        for target in targets:
+            live = self.matches.get(target)
+            if live is None or not live.dirty:
+                continue
+            changes = {field: live.match.get(field) for field in live.dirty}
+            live.dirty = set()
+            try:
+                await db.matches.update_one({"id": target}, {"$set": changes})
+            except Exception:
+                live.dirty |= set(changes)
+                logger.exception("Could not flush live match %s", target)
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(LIVE_FLUSH_INTERVAL)
+            await self.flush()
+
+live_matches = LiveMatchRegistry()
+
+def page_from_memory(docs: List[Dict[str, Any]], response: Response, sort: str, allowed_sorts: List[str],
+                     limit: int, after: Optional[str], fields: Optional[str], model):
+    sort_field, direction = parse_sort(sort, allowed_sorts)
+    docs = sorted(docs, key=lambda doc: (doc.get(sort_field), doc["id"]), reverse=direction == -1)
+    if after:
+        value, last_id = decode_cursor(after)
+        if direction == 1:
+            docs = [doc for doc in docs if (doc.get(sort_field), doc["id"]) > (value, last_id)]
+        else:
+            docs = [doc for doc in docs if (doc.get(sort_field), doc["id"]) < (value, last_id)]
+    headers = {}
+    if len(docs) > limit:
+        docs = docs[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(docs[-1], sort_field)
+    projection = parse_fields(fields, model, sort_field)
+    if projection:
+        docs = [{field: doc.get(field) for field in projection if field != "_id"} for doc in docs]
+    return page_response(docs, headers, response, fields)
+
 # API Routes
 
 @app.get("/")
@@ -276,81 +1375,289 @@ async def root():
 # Teams endpoints
 @app.post("/api/teams", response_model=Team)
 async def create_team(team: Team):
-    team_dict = team.dict()
+    team_dict = await extract_media(team.dict(), "logo")
     await db.teams.insert_one(team_dict)
-    return team
+    return team_dict
 
 @app.get("/api/teams", response_model=List[Team])
-async def get_teams():
-    teams = await db.teams.find().to_list(length=None)
-    return teams
+async def get_teams(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "name",
+    fields: Optional[str] = None,
+):
+    return await paginate(db.teams, {}, response, Team, sort, ["name", "created_at"],
+                          limit, after, fields)
 
 @app.get("/api/teams/{team_id}", response_model=Team)
 async def get_team(team_id: str):
-    team = await db.teams.find_one({"id": team_id})
+    team = await document_cache.get_or_load(
+        f"team:{team_id}", lambda: db.teams.find_one({"id": team_id}, {"_id": 0}))
     if not team:
         raise HTTPException(status_code=404, detail="Team not found")
-    return team
+    return trusted_response(team)
 
 @app.put("/api/teams/{team_id}", response_model=Team)
 async def update_team(team_id: str, team: Team):
-    team_dict = team.dict()
+    team_dict = await extract_media(team.dict(), "logo")
     result = await db.teams.replace_one({"id": team_id}, team_dict)
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Team not found")
-    return team
+    await document_cache.invalidate("team", f"team:{team_id}")
+    return team_dict
 
 @app.delete("/api/teams/{team_id}")
 async def delete_team(team_id: str):
     result = await db.teams.delete_one({"id": team_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Team not found")
-    return {"message": "Team deleted successfully"}
+    await document_cache.invalidate("team", f"team:{team_id}")
+    # Players, stats, matches and events follow in the background
+    job = await cascade_jobs.submit("team", team_id)
+    return {"message": "Team deleted successfully", "job_id": job["id"]}
 
 # Players endpoints
 @app.post("/api/players", response_model=Player)
 async def create_player(player: Player):
-    player_dict = player.dict()
+    player_dict = await extract_media(player.dict(), "photo")
     await db.players.insert_one(player_dict)
-    return player
+    await document_cache.invalidate("player", f"team_players:{player.team_id}:")
+    return player_dict
 
 @app.get("/api/teams/{team_id}/players", response_model=List[Player])
-async def get_team_players(team_id: str):
-    players = await db.players.find({"team_id": team_id}).to_list(length=None)
-    return players
+async def get_team_players(
+    team_id: str,
+    response: Response,
+    position: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "squad_number",
+    fields: Optional[str] = None,
+):
+    query: Dict[str, Any] = {"team_id": team_id}
+    if position:
+        query["position"] = position
+    docs, headers = await document_cache.get_or_load(
+        f"team_players:{team_id}:{position}|{limit}|{after}|{sort}|{fields}",
+        lambda: fetch_page(db.players, query, Player, sort, ["squad_number", "name", "created_at"],
+                           limit, after, fields),
+    )
+    return page_response(docs, headers, response, fields)
 
 @app.get("/api/players/{player_id}", response_model=Player)
 async def get_player(player_id: str):
-    player = await db.players.find_one({"id": player_id})
+    player = await document_cache.get_or_load(
+        f"player:{player_id}", lambda: db.players.find_one({"id": player_id}, {"_id": 0}))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
-    return player
+    return trusted_response(player)
 
 @app.put("/api/players/{player_id}", response_model=Player)
 async def update_player(player_id: str, player: Player):
-    player_dict = player.dict()
+    player_dict = await extract_media(player.dict(), "photo")
     result = await db.players.replace_one({"id": player_id}, player_dict)
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Player not found")
-    return player
+    # The player may have changed team, so every squad list is suspect
+    await document_cache.invalidate("player", f"player:{player_id}", "team_players:")
+    return player_dict
 
 @app.delete("/api/players/{player_id}")
 async def delete_player(player_id: str):
     result = await db.players.delete_one({"id": player_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Player not found")
-    return {"message": "Player deleted successfully"}
+    await document_cache.invalidate("player", f"player:{player_id}", "team_players:")
+    job = await cascade_jobs.submit("player", player_id)
+    return {"message": "Player deleted successfully", "job_id": job["id"]}
+
+# Squad import from CSV: one row per player with a header line. team_id can
+# be a column (for whole-league files) or given once as a query parameter.
+SQUAD_IMPORT_CHUNK = 500
+SQUAD_CSV_COLUMNS = ["team_id", "name", "squad_number", "position", "age", "height", "weight", "nationality"]
+
+def csv_read_error(exc: Exception) -> str:
+    if isinstance(exc, UnicodeDecodeError):
+        return "File is not UTF-8 encoded; save it as CSV UTF-8"
+    return f"Malformed CSV: {exc}"
+
+def read_csv_chunk(reader) -> tuple:
+    # Rows read before an unreadable one are still returned
+    rows: List[Dict[str, Any]] = []
+    try:
+        rows.extend(islice(reader, SQUAD_IMPORT_CHUNK))
+    except (UnicodeDecodeError, csv.Error) as exc:
+        return rows, exc
+    return rows, None
+
+async def import_squad_chunk(rows: List[Any], taken: Dict[str, Set[int]], report: List[Dict[str, Any]]):
+    # Look up numbers already used in these teams; the (team_id, squad_number)
+    # index answers this without touching the player documents
+    new_teams = {player.team_id for _, player in rows} - set(taken)
+    if new_teams:
+        for team_id in new_teams:
+            taken[team_id] = set()
+        async for doc in db.players.find({"team_id": {"$in": list(new_teams)}},
+                                         {"_id": 0, "team_id": 1, "squad_number": 1}):
+            taken[doc["team_id"]].add(doc["squad_number"])
+
+    accepted = []
+    for line, player in rows:
+        if player.squad_number in taken[player.team_id]:
+            report.append({"row": line, "status": "error",
+                           "error": f"Squad number {player.squad_number} is already taken in team {player.team_id}"})
+            continue
+        taken[player.team_id].add(player.squad_number)
+        accepted.append((line, player))
+    if not accepted:
+        return
+
+    positions = {}
+    for line, player in accepted:
+        report.append({"row": line, "status": "created", "id": player.id})
+        positions[player.id] = len(report) - 1
+    try:
+        await db.players.insert_many([player.dict() for _, player in accepted], ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details.get("writeErrors", []):
+            entry = report[positions[accepted[error["index"]][1].id]]
+            entry["status"] = "error"
+            entry["error"] = error.get("errmsg", "Write failed")
+
+@app.post("/api/players/import")
+async def import_players_csv(file: UploadFile = File(...), team_id: Optional[str] = None):
+    # The upload is spooled to a file that may be on disk, so reading and
+    # parsing it runs in the threadpool, a chunk of rows at a time
+    reader = csv.DictReader(io.TextIOWrapper(file.file, encoding="utf-8-sig", newline=""))
+    try:
+        fieldnames = await run_in_threadpool(lambda: reader.fieldnames) or []
+    except (UnicodeDecodeError, csv.Error) as exc:
+        raise HTTPException(status_code=400, detail=csv_read_error(exc))
+    missing = [c for c in ("name", "squad_number", "position") if c not in fieldnames]
+    if not team_id and "team_id" not in fieldnames:
+        missing.append("team_id")
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing CSV columns: {', '.join(missing)}")
+
+    report: List[Dict[str, Any]] = []
+    taken: Dict[str, Set[int]] = {}
+    line = 1
+    error = None
+    while error is None:
+        rows, error = await run_in_threadpool(read_csv_chunk, reader)
+        if not rows:
+            break
+        chunk: List[Any] = []
+        for row in rows:
+            line += 1
+            values = {k: (row.get(k) or "").strip() or None for k in SQUAD_CSV_COLUMNS}
+            values["team_id"] = values["team_id"] or team_id
+            try:
+                player = Player(**{k: v for k, v in values.items() if v is not None})
+            except ValidationError as exc:
+                report.append({"row": line, "status": "error", "error": str(exc)})
+                continue
+            chunk.append((line, player))
+        if chunk:
+            await import_squad_chunk(chunk, taken, report)
+
+    created = sum(1 for entry in report if entry["status"] == "created")
+    if created:
+        await document_cache.invalidate("player", "team_players:")
+    report.sort(key=lambda entry: entry["row"])
+    result = {"created": created, "failed": len(report) - created, "rows": report}
+    if error is not None:
+        # The rows before it are already imported, so say where to pick up from
+        return FastJSONResponse(status_code=400, content={
+            "detail": f"Stopped at row {line + 1}: {csv_read_error(error)}", "row": line + 1, **result})
+    return result
+
+# Admin endpoints
+@app.get("/api/admin/index-report")
+async def get_index_report():
+    if STORAGE_BACKEND != "mongo":
+        raise HTTPException(status_code=501, detail="Query plans are only available with mongo storage")
+    return await index_report()
+
+@app.get("/api/admin/cache-stats")
+async def get_cache_stats():
+    return {
+        "documents": document_cache.stats(),
+        "leaderboards": leaderboard_cache.stats(),
+        "idempotency": idempotency_cache.stats(),
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Media endpoints
+@app.post("/api/media")
+async def upload_media(file: UploadFile = File(...)):
+    # One byte over the cap is enough to reject without reading the rest
+    data = await file.read(MAX_MEDIA_BYTES + 1)
+    digest = await store_media_bytes(data, check_image(data))
+    return {"hash": digest, "url": f"/api/media/{digest}"}
+
+@app.get("/api/media/{media_hash}")
+async def get_media(media_hash: str, request: Request):
+    etag = f'"{media_hash}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL, "X-Content-Type-Options": "nosniff"}
+    # The hash is the content, so a matching ETag never needs a DB lookup
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    media = await db.media.find_one({"hash": media_hash}, {"_id": 0, "data": 1, "content_type": 1})
+    if not media:
+        raise HTTPException(status_code=404, detail="Media not found")
+    data = bytes(media["data"])
+    # Re-checked on the way out too, for anything stored before uploads were sniffed
+    content_type = sniff_image_type(data)
+    if content_type is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    return Response(content=data, media_type=content_type, headers=headers)
 
 # Formations endpoints
 @app.get("/api/formations")
-async def get_formations():
-    return FORMATIONS
+async def get_formations(request: Request):
+    return await formation_cache.response(None, request)
+
+@app.post("/api/formations", response_model=Formation)
+async def create_formation(formation: Formation):
+    if formation.name in FORMATIONS:
+        raise HTTPException(status_code=409, detail="Built-in formations cannot be redefined")
+    try:
+        await db.formations.insert_one(formation.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Formation already exists")
+    await formation_cache.reload()
+    return formation
 
 @app.get("/api/formations/{formation_name}")
-async def get_formation(formation_name: str):
-    if formation_name not in FORMATIONS:
+async def get_formation(formation_name: str, request: Request):
+    return await formation_cache.response(formation_name, request)
+
+@app.put("/api/formations/{formation_name}", response_model=Formation)
+async def update_formation(formation_name: str, formation: Formation):
+    if formation_name in FORMATIONS:
+        raise HTTPException(status_code=409, detail="Built-in formations cannot be changed")
+    formation_dict = formation.dict()
+    formation_dict["name"] = formation_name
+    result = await db.formations.replace_one({"name": formation_name}, formation_dict)
+    if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Formation not found")
-    return FORMATIONS[formation_name]
+    await formation_cache.reload()
+    return formation_dict
+
+@app.delete("/api/formations/{formation_name}")
+async def delete_formation(formation_name: str):
+    if formation_name in FORMATIONS:
+        raise HTTPException(status_code=409, detail="Built-in formations cannot be deleted")
+    result = await db.formations.delete_one({"name": formation_name})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Formation not found")
+    await formation_cache.reload()
+    return {"message": "Formation deleted successfully"}
 
 # Matches endpoints
 @app.post("/api/matches", response_model=Match)
@@ -360,108 +1667,1353 @@ async def create_match(match: Match):
     return match
 
 @app.get("/api/matches", response_model=List[Match])
-async def get_matches():
-    matches = await db.matches.find().to_list(length=None)
-    return matches
+async def get_matches(
+    response: Response,
+    status: Optional[str] = None,
+    team_id: Optional[str] = None,
+    match_type: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "-match_date",
+    fields: Optional[str] = None,
+):
+    query: Dict[str, Any] = {}
+    if status:
+        query["status"] = status
+    if match_type:
+        query["match_type"] = match_type
+    if team_id:
+        query["$or"] = [{"home_team_id": team_id}, {"away_team_id": team_id}]
+    if date_from or date_to:
+        query["match_date"] = {}
+        if date_from:
+            query["match_date"]["$gte"] = date_from
+        if date_to:
+            query["match_date"]["$lte"] = date_to
+    return await paginate(db.matches, query, response, Match, sort, ["match_date", "created_at"],
+                          limit, after, fields)
 
 @app.get("/api/matches/{match_id}", response_model=Match)
 async def get_match(match_id: str):
-    match = await db.matches.find_one({"id": match_id})
+    live = live_matches.get(match_id)
+    if live is not None:
+        return trusted_response(live.match)
+    match = await document_cache.get_or_load(
+        f"match:{match_id}", lambda: db.matches.find_one({"id": match_id}, {"_id": 0}))
     if not match:
         raise HTTPException(status_code=404, detail="Match not found")
+    return trusted_response(match)
+
+async def apply_match_update(match_id: str, update: Dict[str, Any], expected_version: Optional[int] = None,
+                             minimums: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    # minimums: fields that must be at least this before the update, checked
+    # in the same write so concurrent decrements can't take them below it
+    query: Dict[str, Any] = {"id": match_id}
+    if expected_version is not None:
+        # Matches stored before versioning have no field, which counts as 0
+        query["version"] = expected_version if expected_version else {"$in": [0, None]}
+    for field, minimum in (minimums or {}).items():
+        query[field] = {"$gte": minimum}
+    update.setdefault("$inc", {})["version"] = 1
+    if live_matches.get(match_id) is not None:
+        match = live_matches.update(match_id, update, expected_version, minimums)
+        if match["status"] != "live":
+            # Full time (or abandoned): persist now and stop holding it
+            await live_matches.finish(match_id)
+            await document_cache.invalidate("match", f"match:{match_id}")
+    else:
+        match = await db.matches.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+        if match is None:
+            current = None
+            if expected_version is not None or minimums:
+                current = await db.matches.find_one({"id": match_id}, {"_id": 0})
+            if current is None:
+                raise HTTPException(status_code=404, detail="Match not found")
+            if expected_version is not None and (current.get("version") or 0) != expected_version:
+                raise HTTPException(status_code=409, detail="Match was modified by someone else")
+            check_minimums(current, minimums or {})
+            # Changed again between the write and the read
+            raise HTTPException(status_code=409, detail="Match was modified by someone else")
+        await document_cache.invalidate("match", f"match:{match_id}")
+        if match["status"] == "live" and LIVE_MATCH_STATE == "memory":
+            await live_matches.track(match)
+    changes = {field: match.get(field) for field in updated_fields(update)}
+    await publish_match_delta(match_id, {"type": "match", "changes": changes},
+                              [match["home_team_id"], match["away_team_id"]])
     return match
 
+def side_prefix(side: str) -> str:
+    if side not in ("home", "away"):
+        raise HTTPException(status_code=400, detail="side must be 'home' or 'away'")
+    return side
+
 @app.put("/api/matches/{match_id}", response_model=Match)
 async def update_match(match_id: str, match: Match):
-    match_dict = match.dict()
-    result = await db.matches.replace_one({"id": match_id}, match_dict)
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Match not found")
-    await manager.broadcast(f"match_updated:{match_id}")
-    return match
+    match_dict = match.dict(exclude={"id", "version"})
+    return await apply_match_update(match_id, {"$set": match_dict})
+
+@app.patch("/api/matches/{match_id}/score", response_model=Match)
+async def patch_match_score(match_id: str, score: ScoreUpdate):
+    update: Dict[str, Any] = {}
+    minimums: Dict[str, int] = {}
+    for side in ("home", "away"):
+        absolute, delta = getattr(score, f"{side}_score"), getattr(score, f"{side}_delta")
+        if absolute is not None and delta is not None:
+            raise HTTPException(status_code=400, detail=f"Give either {side}_score or {side}_delta, not both")
+        if absolute is not None:
+            update.setdefault("$set", {})[f"{side}_score"] = absolute
+        if delta is not None:
+            update.setdefault("$inc", {})[f"{side}_score"] = delta
+            if delta < 0:
+                minimums[f"{side}_score"] = -delta
+    if not update:
+        raise HTTPException(status_code=400, detail="No score change given")
+    return await apply_match_update(match_id, update, score.expected_version, minimums)
+
+@app.patch("/api/matches/{match_id}/status", response_model=Match)
+async def patch_match_status(match_id: str, status: StatusUpdate):
+    if status.status not in MATCH_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(MATCH_STATUSES)}")
+    return await apply_match_update(match_id, {"$set": {"status": status.status}}, status.expected_version)
+
+@app.patch("/api/matches/{match_id}/lineup", response_model=Match)
+async def patch_match_lineup(match_id: str, lineup: LineupUpdate):
+    side = side_prefix(lineup.side)
+    update: Dict[str, Any] = {}
+    for field, replacement, additions, removals in (
+        (f"{side}_lineup", lineup.lineup, lineup.add_to_lineup, lineup.remove_from_lineup),
+        (f"{side}_substitutes", lineup.substitutes, lineup.add_substitutes, lineup.remove_substitutes),
+    ):
+        if replacement is not None and (additions or removals):
+            raise HTTPException(status_code=400, detail=f"Replace {field} or add/remove players, not both")
+        if additions and removals:
+            # Mongo rejects $addToSet and $pull on the same array in one update
+            raise HTTPException(status_code=400, detail=f"Add to or remove from {field}, not both at once")
+        if replacement is not None:
+            update.setdefault("$set", {})[field] = replacement
+        if additions:
+            update.setdefault("$addToSet", {})[field] = {"$each": additions}
+        if removals:
+            update.setdefault("$pull", {})[field] = {"$in": removals}
+    if not update:
+        raise HTTPException(status_code=400, detail="No lineup change given")
+    return await apply_match_update(match_id, update, lineup.expected_version)
+
+@app.patch("/api/matches/{match_id}/formation", response_model=Match)
+async def patch_match_formation(match_id: str, formation: FormationUpdate):
+    side = side_prefix(formation.side)
+    if formation.formation not in formation_cache.by_name:
+        raise HTTPException(status_code=400, detail="Unknown formation")
+    return await apply_match_update(
+        match_id, {"$set": {f"{side}_formation": formation.formation}}, formation.expected_version,
+    )
+
+# Side effects of a stored event (stats, match cache, broadcast) run on a
+# background worker so posting an event costs one insert. A single worker
+# keeps broadcasts in order; stats for a whole batch go out as one bulk write.
+EVENT_SIDE_EFFECTS = os.getenv("EVENT_SIDE_EFFECTS", "queue")  # queue or inline
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "200"))
+EVENT_RETRY_ATTEMPTS = int(os.getenv("EVENT_RETRY_ATTEMPTS", "5"))
+EVENT_DRAIN_TIMEOUT = float(os.getenv("EVENT_DRAIN_TIMEOUT", "30"))
+
+class EventSideEffects:
+    def __init__(self):
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.stats_lock = asyncio.Lock()
+        self.counted_before: Optional[ObjectId] = None
+        # Players recounted after a failed write, with the recount's cutoff
+        self.recounted: Dict[str, ObjectId] = {}
+        # Events whose stats wait for a rebuild to finish
+        self.held: List[Dict[str, Any]] = []
+        self.held_writer: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.worker = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self.worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), EVENT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Dropped %d queued event side effects on shutdown", self.queue.qsize())
+        self.worker.cancel()
+        self.worker = None
+        if self.held_writer is not None:
+            try:
+                await asyncio.wait_for(self.held_writer, EVENT_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error("Dropped stats for %d held events on shutdown", len(self.held))
+    
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+    
+    @asynccontextmanager
+    async def rebuilding(self):
+        # Holds stats writes while a rebuild recounts from match_events. The
+        # rebuild counts events stored before the cutoff, so their held $incs
+        # are dropped afterwards instead of being applied on top.
+        async with self.stats_lock:
+            cutoff = ObjectId()
+            yield cutoff
+            self.counted_before = cutoff
+            self.recounted.clear()
+    
+    async def submit(self, events: List[Dict[str, Any]], deltas: List[tuple]):
+        # deltas are (match_id, payload, team_ids) for publish_match_delta
+        if self.worker is None:
+            await self.process([(events, deltas)])
+        else:
+            # Waits when the queue is full rather than growing without bound
+            await self.queue.put((events, deltas))
+    
+    async def process(self, items: List[tuple]):
+        events = [event for item_events, _ in items for event in item_events]
+        event_batch_size.observe(len(events))
+        if self.worker is not None and self.stats_lock.locked():
+            # A rebuild holds the lock; the stats wait for it but the
+            # broadcasts below go out now
+            self._hold(events)
+        else:
+            await self._write_stats(events)
+        try:
+            await document_cache.invalidate("match", *{f"match:{event['match_id']}" for event in events})
+        except Exception:
+            logger.exception("Could not invalidate cached matches")
+        for _, deltas in items:
+            for match_id, payload, team_ids in deltas:
+                try:
+                    await publish_match_delta(match_id, payload, team_ids)
+                except Exception:
+                    logger.exception("Could not broadcast events for match %s", match_id)
+    
+    def _hold(self, events: List[Dict[str, Any]]):
+        self.held.extend(events)
+        if self.held_writer is None or self.held_writer.done():
+            self.held_writer = asyncio.create_task(self._write_held())
+    
+    async def _write_held(self):
+        while self.held:
+            events, self.held = self.held, []
+            try:
+                await self._write_stats(events)
+            except Exception:
+                logger.exception("Event side effects failed")
+    
+    async def _write_stats(self, events: List[Dict[str, Any]]):
+        async with self.stats_lock:
+            if self.counted_before is not None:
+                events = [event for event in events if event["_id"] >= self.counted_before]
+            if self.recounted:
+                events = [event for event in events
+                          if event["_id"] >= self.recounted.get(event["player_id"], event["_id"])]
+            await self._apply_stats(events)
+    
+    async def _apply_stats(self, events: List[Dict[str, Any]]):
+        operations = stat_operations(events)
+        for attempt in range(EVENT_RETRY_ATTEMPTS):
+            if not operations:
+                break
+            try:
+                await db.player_stats.bulk_write(operations, ordered=False)
+                operations = []
+            except BulkWriteError as exc:
+                # The rest were applied; only retry what failed so nothing is counted twice
+                failed = {error["index"] for error in exc.details.get("writeErrors", [])}
+                operations = [operation for index, operation in enumerate(operations) if index in failed]
+            except Exception:
+                # Some of the $incs may have landed, so retrying them could count
+                # twice; recount these players from match_events instead
+                logger.exception("Player stats update failed with an unknown outcome")
+                if await self._recount(sorted({event["player_id"] for event in events})):
+                    operations = []
+                break
+            if operations:
+                event_retries.inc()
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+        try:
+            await leaderboard_cache.invalidate("stats", "leaderboard:")
+        except Exception:
+            logger.exception("Could not invalidate cached leaderboards")
+        if operations:
+            event_failures.inc(amount=len(operations))
+            logger.error("Gave up on %d player stat updates; run rebuild-stats to reconcile", len(operations))
+    
+    async def _recount(self, player_ids: List[str]) -> bool:
+        # Events stored before the cutoff are in the recount, so their queued
+        # $incs are dropped like those held during a rebuild
+        for attempt in range(EVENT_RETRY_ATTEMPTS):
+            event_retries.inc()
+            await asyncio.sleep(min(0.1 * 2 ** attempt, 5))
+            cutoff = ObjectId()
+            try:
+                await recount_player_stats(player_ids, cutoff)
+            except Exception:
+                logger.exception("Could not recount player stats")
+                continue
+            for player_id in player_ids:
+                self.recounted[player_id] = cutoff
+            return True
+        return False
+    
+    async def _run(self):
+        while True:
+            items = [await self.queue.get()]
+            while len(items) < EVENT_BATCH_SIZE and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await self.process(items)
+            except Exception:
+                logger.exception("Event side effects failed")
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+side_effects = EventSideEffects()
+
+event_queue_depth = Gauge("event_side_effect_queue_depth", "Stored events waiting for stats and broadcast.",
+                          function=side_effects.depth)
+event_batch_size = Histogram("event_side_effect_batch_size", "Events handled per side-effect batch.",
+                             buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+event_retries = Counter("event_side_effect_retries_total", "Retried player stat bulk writes.")
+event_failures = Counter("event_side_effect_failures_total", "Player stat updates given up after retries.")
 
 # Match Events endpoints
+
+# Retried submissions are recognised by event id, which is derived from the
+# Idempotency-Key header (scoped to the match) when one is sent. The unique
+# index on id makes the database the source of truth; the cache just saves
+# the round trip. A key reused for a different event is rejected.
+IDEMPOTENCY_NAMESPACE = uuid.UUID("5b0d8c1e-3f7a-4c1e-9a57-6f1d2e4b8a90")
+IDEMPOTENT_FIELDS = ("match_id", "event_type", "player_id", "team_id", "minute", "additional_data")
+idempotency_cache = TTLCache(maxsize=10000, ttl=float(os.getenv("IDEMPOTENCY_TTL", "600")))
+
+def idempotent_event_id(match_id: str, key: str) -> str:
+    return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, f"{match_id}:{key}"))
+
+def event_identity(event: Dict[str, Any]) -> tuple:
+    return tuple(event.get(field) for field in IDEMPOTENT_FIELDS)
+
+def replay_event(identity: tuple, cached: tuple) -> Response:
+    stored_identity, body = cached
+    if stored_identity != identity:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different event")
+    return Response(content=body, media_type="application/json")
+
 @app.post("/api/match-events", response_model=MatchEvent)
-async def create_match_event(event: MatchEvent):
+async def create_match_event(event: MatchEvent, idempotency_key: Optional[str] = Header(None)):
+    if idempotency_key:
+        event.id = idempotent_event_id(event.match_id, idempotency_key)
     event_dict = event.dict()
-    await db.match_events.insert_one(event_dict)
-    
-    # Update player statistics
-    await update_player_statistics(event.player_id, event.event_type)
+    identity = event_identity(event_dict)
+    cached = idempotency_cache.get(event.id)
+    if cached is not None:
+        return replay_event(identity, cached)
+
+    try:
+        # The stored copy gets the _id, which side effects use to order it
+        # against a stats rebuild
+        document = dict(event_dict)
+        await db.match_events.insert_one(document)
+    except DuplicateKeyError:
+        # A retry of an event we already stored: replay it, don't recount it
+        existing = await db.match_events.find_one({"id": event.id}, {"_id": 0})
+        cached = (event_identity(existing), dump_json(existing))
+        idempotency_cache.set(event.id, cached)
+        return replay_event(identity, cached)
+
+    # Serialized once for the response, the retry cache and the broadcast
+    body = dump_json(event_dict)
+    idempotency_cache.set(event.id, (identity, body))
+    live_matches.add_events([event_dict])
     
-    # Broadcast to websocket connections
-    await manager.broadcast(f"match_event:{event.match_id}:{json.dumps(event_dict, default=str)}")
-    return event
+    # Stats and the websocket broadcast follow once the event is stored
+    await side_effects.submit([document], [(event.match_id, {"type": "event", "event": body}, [event.team_id])])
+    return Response(content=body, media_type="application/json")
+
+MAX_BULK_EVENTS = 500
+
+@app.post("/api/match-events/bulk")
+async def create_match_events_bulk(events: List[Dict[str, Any]] = Body(...)):
+    if len(events) > MAX_BULK_EVENTS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_EVENTS} events per request")
+
+    # Validate items one by one so a bad event doesn't reject the whole queue
+    results: List[Dict[str, Any]] = []
+    valid: List[Dict[str, Any]] = []
+    positions: List[int] = []
+    for index, item in enumerate(events):
+        try:
+            event_dict = MatchEvent(**item).dict()
+        except (ValidationError, TypeError) as exc:
+            results.append({"index": index, "status": "error", "error": str(exc)})
+            continue
+        results.append({"index": index, "id": event_dict["id"], "status": "created"})
+        valid.append(event_dict)
+        positions.append(len(results) - 1)
+
+    failed_writes: Set[int] = set()
+    documents = [dict(e) for e in valid]
+    if valid:
+        try:
+            await db.match_events.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            for error in exc.details.get("writeErrors", []):
+                failed_writes.add(error["index"])
+                result = results[positions[error["index"]]]
+                if error.get("code") == 11000:
+                    # Already stored by an earlier attempt of this queue
+                    result["status"] = "duplicate"
+                else:
+                    result["status"] = "error"
+                    result["error"] = error.get("errmsg", "Write failed")
+
+    stored = [event for i, event in enumerate(valid) if i not in failed_writes]
+    if stored:
+        live_matches.add_events(stored)
+
+        # One message per match rather than one per event
+        by_match: Dict[str, List[Dict[str, Any]]] = {}
+        for event in stored:
+            by_match.setdefault(event["match_id"], []).append(event)
+        await side_effects.submit([doc for i, doc in enumerate(documents) if i not in failed_writes], [
+            (match_id, {"type": "events", "events": match_events}, sorted({e["team_id"] for e in match_events}))
+            for match_id, match_events in by_match.items()
+        ])
+
+    duplicates = sum(1 for result in results if result["status"] == "duplicate")
+    return {
+        "created": len(stored),
+        "duplicates": duplicates,
+        "failed": len(results) - len(stored) - duplicates,
+        "results": results,
+    }
 
 @app.get("/api/matches/{match_id}/events", response_model=List[MatchEvent])
-async def get_match_events(match_id: str):
-    events = await db.match_events.find({"match_id": match_id}).to_list(length=None)
-    return events
+async def get_match_events(
+    match_id: str,
+    response: Response,
+    event_type: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "minute",
+    fields: Optional[str] = None,
+):
+    live = live_matches.get(match_id)
+    if live is not None:
+        events = [e for e in live.events if not event_type or e["event_type"] == event_type]
+        return page_from_memory(events, response, sort, ["minute", "timestamp"], limit, after, fields, MatchEvent)
+    query: Dict[str, Any] = {"match_id": match_id}
+    if event_type:
+        query["event_type"] = event_type
+    return await paginate(db.match_events, query, response, MatchEvent, sort, ["minute", "timestamp"],
+                          limit, after, fields)
+
+@app.get("/api/match-events", response_model=List[MatchEvent])
+async def query_match_events(
+    response: Response,
+    match_id: Optional[str] = None,
+    player_id: Optional[str] = None,
+    team_id: Optional[str] = None,
+    event_type: Optional[List[str]] = Query(None),
+    minute_from: Optional[int] = None,
+    minute_to: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    season: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    sort: str = "timestamp",
+    fields: Optional[str] = None,
+):
+    query: Dict[str, Any] = {}
+    for field, value in (("match_id", match_id), ("player_id", player_id), ("team_id", team_id)):
+        if value:
+            query[field] = value
+    if event_type:
+        query["event_type"] = event_type[0] if len(event_type) == 1 else {"$in": event_type}
+    if not query:
+        raise HTTPException(status_code=400, detail="Filter by at least one of match_id, player_id, team_id or event_type")
+    if minute_from is not None or minute_to is not None:
+        query["minute"] = {}
+        if minute_from is not None:
+            query["minute"]["$gte"] = minute_from
+        if minute_to is not None:
+            query["minute"]["$lte"] = minute_to
+    # Stored timestamps are naive UTC
+    since, until = (t.astimezone(timezone.utc).replace(tzinfo=None) if t and t.tzinfo else t for t in (since, until))
+    if since or until or season is not None:
+        query["timestamp"] = {}
+        if season is not None:
+            query["timestamp"]["$gte"], query["timestamp"]["$lt"] = season_bounds(season)
+        if since:
+            query["timestamp"]["$gte"] = max(since, query["timestamp"].get("$gte", since))
+        if until:
+            query["timestamp"]["$lte"] = until
+    return await paginate(db.match_events, query, response, MatchEvent, sort, ["timestamp", "minute"],
+                          limit, after, fields)
 
 # Statistics endpoints
 @app.get("/api/players/{player_id}/stats", response_model=PlayerStats)
 async def get_player_stats(player_id: str):
     stats = await db.player_stats.find_one({"player_id": player_id})
     if not stats:
-        # Create empty stats if none exist
-        stats = PlayerStats(player_id=player_id, team_id="")
-        await db.player_stats.insert_one(stats.dict())
+        # Create empty stats if none exist; an upsert, so two first reads at
+        # once don't both insert
+        empty = PlayerStats(player_id=player_id, team_id="").dict()
+        try:
+            stats = await db.player_stats.find_one_and_update(
+                {"player_id": player_id}, {"$setOnInsert": empty}, upsert=True, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            stats = await db.player_stats.find_one({"player_id": player_id})
     return stats
 
+def stats_from_totals_pipeline(team_ids: List[str]) -> List[Dict[str, Any]]:
+    return [
+        {"$match": {"team_id": {"$in": team_ids}}},
+        {"$lookup": {"from": "player_stats", "localField": "id", "foreignField": "player_id", "as": "stats"}},
+        {"$unwind": "$stats"},
+        {"$project": {
+            "_id": 0, "player_id": "$id", "team_id": 1,
+            "player_name": "$name", "squad_number": 1,
+            **{field: f"$stats.{field}" for field in STAT_FIELDS},
+        }},
+    ]
+
+def stats_from_events_pipeline(team_ids: Optional[List[str]], season: Optional[int],
+                               competition: Optional[str], by_team: bool = True) -> List[Dict[str, Any]]:
+    match_query: Dict[str, Any] = {}
+    if team_ids is not None:
+        match_query["$or"] = [{"home_team_id": {"$in": team_ids}}, {"away_team_id": {"$in": team_ids}}]
+    if season is not None:
+        start, end = season_bounds(season)
+        match_query["match_date"] = {"$gte": start, "$lt": end}
+    if competition:
+        match_query["match_type"] = competition
+
+    counters = event_counter_sums()
+    return [
+        {"$match": match_query},
+        {"$lookup": {"from": "match_events", "localField": "id", "foreignField": "match_id", "as": "event"}},
+        {"$unwind": "$event"},
+        {"$replaceRoot": {"newRoot": "$event"}},
+        {"$match": {"team_id": {"$in": team_ids}} if team_ids is not None else {}},
+        # Keyed on the team the event was recorded for, not the player's current
+        # team, so a transferred player's goals stay with the side they scored for.
+        # Without by_team a player's goals for every side are added up and the
+        # row carries their current team.
+        {"$group": {"_id": {"player_id": "$player_id", "team_id": "$team_id" if by_team else None}, **counters}},
+        {"$lookup": {"from": "players", "localField": "_id.player_id", "foreignField": "id", "as": "player"}},
+        {"$unwind": "$player"},
+        {"$project": {
+            "_id": 0, "player_id": "$_id.player_id", "team_id": "$_id.team_id" if by_team else "$player.team_id",
+            "player_name": "$player.name", "squad_number": "$player.squad_number",
+            **{counter: 1 for counter in EVENT_STAT_COUNTERS.values()},
+        }},
+    ]
+
+async def team_stats(team_ids: List[str], sort: str = "goals", season: Optional[int] = None,
+                     competition: Optional[str] = None) -> List[Dict[str, Any]]:
+    if sort not in STAT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by '{sort}'")
+    if season is None and not competition:
+        pipeline = stats_from_totals_pipeline(team_ids)
+        collection = db.players
+    else:
+        pipeline = stats_from_events_pipeline(team_ids, season, competition)
+        collection = db.matches
+    pipeline.append({"$sort": {"team_id": 1, sort: -1, "squad_number": 1}})
+    rows = await collection.aggregate(pipeline).to_list(length=None)
+
+    # Standard competition ranking within each team: ties share a rank
+    previous = None
+    for position, row in enumerate(rows):
+        row.setdefault(sort, 0)
+        if previous is None or previous["team_id"] != row["team_id"]:
+            first = position
+        if previous is not None and previous["team_id"] == row["team_id"] and previous[sort] == row[sort]:
+            row["rank"] = previous["rank"]
+        else:
+            row["rank"] = position - first + 1
+        previous = row
+    return rows
+
 @app.get("/api/teams/{team_id}/stats")
-async def get_team_stats(team_id: str):
-    players = await db.players.find({"team_id": team_id}).to_list(length=None)
-    team_stats = []
+async def get_team_stats(
+    team_id: str,
+    sort: str = "goals",
+    season: Optional[int] = None,
+    competition: Optional[str] = None,
+):
+    return await team_stats([team_id], sort, season, competition)
+
+@app.get("/api/stats/teams")
+async def get_multi_team_stats(
+    team_id: List[str] = Query(...),
+    sort: str = "goals",
+    season: Optional[int] = None,
+    competition: Optional[str] = None,
+):
+    rows = await team_stats(team_id, sort, season, competition)
+    grouped: Dict[str, List[Dict[str, Any]]] = {tid: [] for tid in team_id}
+    for row in rows:
+        grouped[row["team_id"]].append(row)
+    return grouped
+
+# Leaderboards are read far more often than stats change, so results are
+# cached until the next stats write. Writes bump the "stats" cache version,
+# so other workers drop their boards too.
+LEADERBOARD_MAX_LIMIT = 100
+leaderboard_cache = DocumentCache(
+    maxsize=1000,
+    ttl=float(os.getenv("LEADERBOARD_TTL", "300")),
+    kinds={"stats": ["leaderboard:"]},
+)
+
+async def leaderboard(metric: str, team_id: Optional[str] = None, season: Optional[int] = None,
+                      competition: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+    if season is None and not competition:
+        # Served straight off the per-counter descending index on player_stats
+        query: Dict[str, Any] = {metric: {"$gt": 0}}
+        if team_id:
+            query["team_id"] = team_id
+        pipeline = [
+            {"$match": query},
+            {"$sort": {metric: -1, "player_id": 1}},
+            {"$limit": limit},
+            {"$lookup": {"from": "players", "localField": "player_id", "foreignField": "id", "as": "player"}},
+            {"$unwind": "$player"},
+            {"$project": {
+                "_id": 0, "player_id": 1, "team_id": 1, metric: 1,
+                "player_name": "$player.name", "squad_number": "$player.squad_number",
+            }},
+        ]
+        collection = db.player_stats
+    else:
+        pipeline = stats_from_events_pipeline([team_id] if team_id else None, season, competition,
+                                              by_team=bool(team_id))
+        pipeline += [
+            {"$match": {metric: {"$gt": 0}}},
+            {"$sort": {metric: -1, "player_id": 1}},
+            {"$limit": limit},
+        ]
+        collection = db.matches
+    rows = await collection.aggregate(pipeline).to_list(length=limit)
+
+    previous = None
+    for position, row in enumerate(rows):
+        row["rank"] = previous["rank"] if previous and previous[metric] == row[metric] else position + 1
+        previous = row
+    return rows
+
+@app.get("/api/leaderboards/{metric}")
+async def get_leaderboard(
+    metric: str,
+    team_id: Optional[str] = None,
+    season: Optional[int] = None,
+    competition: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=LEADERBOARD_MAX_LIMIT),
+):
+    if metric not in EVENT_STAT_COUNTERS.values():
+        raise HTTPException(status_code=404, detail="Leaderboard not found")
+    key = f"leaderboard:{metric}|{team_id}|{season}|{competition}|{limit}"
+    return await leaderboard_cache.get_or_load(
+        key, lambda: leaderboard(metric, team_id, season, competition, limit))
+
+# Helper functions to update player statistics
+def stat_update(player_id: str, team_id: str, deltas: Dict[str, int]) -> Dict[str, Any]:
+    # Counters being incremented must not also appear in $setOnInsert
+    defaults = {field: 0 for field in STAT_FIELDS if field not in deltas}
+    update: Dict[str, Any] = {"$setOnInsert": {"player_id": player_id, "team_id": team_id, **defaults}}
+    if deltas:
+        update["$inc"] = deltas
+    return update
+
+def stat_operations(events: List[Dict[str, Any]]) -> List[UpdateOne]:
+    deltas: Dict[str, Dict[str, int]] = {}
+    teams: Dict[str, str] = {}
+    for event in events:
+        player_deltas = deltas.setdefault(event["player_id"], {})
+        teams[event["player_id"]] = event["team_id"]
+        counter = EVENT_STAT_COUNTERS.get(event["event_type"])
+        if counter:
+            player_deltas[counter] = player_deltas.get(counter, 0) + 1
+    return [
+        UpdateOne({"player_id": player_id}, stat_update(player_id, teams[player_id], player_deltas), upsert=True)
+        for player_id, player_deltas in deltas.items()
+    ]
+
+# Stats rebuild: recompute the event-derived counters from match_events
+REBUILD_BATCH_SIZE = 1000
+REBUILD_STATE_ID = "stats_rebuild"
+
+async def rebuild_player_stats(since: Optional[datetime] = None, incremental: bool = False) -> Dict[str, Any]:
+    # Stats writes from this process's side effects wait until the rebuild is done
+    async with side_effects.rebuilding() as cutoff:
+        return await recount_all_player_stats(since, incremental, cutoff)
+
+async def recount_all_player_stats(since: Optional[datetime], incremental: bool, cutoff: ObjectId) -> Dict[str, Any]:
+    started_at = datetime.utcnow()
+    if incremental and since is None:
+        state = await db.meta.find_one({"_id": REBUILD_STATE_ID})
+        since = state["watermark"] if state else None
+
+    # Events are ordered by when the server stored them (the _id), not by the
+    # client's timestamp, so late uploads of offline events are still picked up
+    event_query: Dict[str, Any] = {"_id": {"$lt": cutoff}}
+    if since is not None:
+        # Totals are cumulative, so recount every event of each player touched
+        # since the watermark rather than just the new events
+        stored_since = {"_id": {"$gte": ObjectId.from_datetime(since), "$lt": cutoff}}
+        player_ids = await db.match_events.distinct("player_id", stored_since)
+        event_query["player_id"] = {"$in": player_ids}
+
+    counters = event_counter_sums()
+    pipeline = [
+        {"$match": event_query},
+        {"$group": {"_id": "$player_id", "team_id": {"$last": "$team_id"}, **counters}},
+    ]
+
+    updated = 0
+    batch: List[UpdateOne] = []
+    async for row in db.match_events.aggregate(pipeline, allowDiskUse=True):
+        values = {counter: row[counter] for counter in EVENT_STAT_COUNTERS.values()}
+        defaults = {field: 0 for field in STAT_FIELDS if field not in values}
+        batch.append(UpdateOne(
+            {"player_id": row["_id"]},
+            {"$set": {**values, "rebuilt_at": started_at},
+             "$setOnInsert": {"player_id": row["_id"], "team_id": row["team_id"], **defaults}},
+            upsert=True,
+        ))
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            await db.player_stats.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await db.player_stats.bulk_write(batch, ordered=False)
+        updated += len(batch)
+
+    reset = 0
+    if since is None:
+        # Players whose events have all been deleted drop back to zero
+        result = await db.player_stats.update_many(
+            {"rebuilt_at": {"$ne": started_at}},
+            {"$set": {**{counter: 0 for counter in EVENT_STAT_COUNTERS.values()}, "rebuilt_at": started_at}},
+        )
+        reset = result.modified_count
+
+    await leaderboard_cache.invalidate("stats", "leaderboard:")
+    await db.meta.update_one({"_id": REBUILD_STATE_ID}, {"$set": {"watermark": started_at}}, upsert=True)
+    return {
+        "mode": "full" if since is None else "incremental",
+        "since": since,
+        "updated": updated,
+        "reset": reset,
+        "watermark": started_at,
+        "duration_seconds": round((datetime.utcnow() - started_at).total_seconds(), 3),
+    }
+
+@app.post("/api/admin/rebuild-stats")
+async def post_rebuild_stats(since: Optional[datetime] = None, incremental: bool = False):
+    return await rebuild_player_stats(since, incremental)
+
+async def recount_player_stats(player_ids: List[str], cutoff: Optional[ObjectId] = None):
+    # Event counters for just these players, from the events that remain
+    # (those stored before the cutoff, when one is given)
+    found: Set[str] = set()
+    operations: List[UpdateOne] = []
+    query: Dict[str, Any] = {"player_id": {"$in": player_ids}}
+    if cutoff is not None:
+        query["_id"] = {"$lt": cutoff}
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": "$player_id", "team_id": {"$last": "$team_id"}, **event_counter_sums()}},
+    ]
+    async for row in db.match_events.aggregate(pipeline):
+        found.add(row["_id"])
+        values = {counter: row[counter] for counter in EVENT_STAT_COUNTERS.values()}
+        defaults = {field: 0 for field in STAT_FIELDS if field not in values}
+        operations.append(UpdateOne(
+            {"player_id": row["_id"]},
+            {"$set": values, "$setOnInsert": {"player_id": row["_id"], "team_id": row["team_id"], **defaults}},
+            upsert=True,
+        ))
+    zero = {counter: 0 for counter in EVENT_STAT_COUNTERS.values()}
+    operations += [UpdateOne({"player_id": player_id}, {"$set": zero}) for player_id in player_ids
+                   if player_id not in found]
+    for start in range(0, len(operations), REBUILD_BATCH_SIZE):
+        await db.player_stats.bulk_write(operations[start:start + REBUILD_BATCH_SIZE], ordered=False)
+    await leaderboard_cache.invalidate("stats", "leaderboard:")
+
+# Cascade deletes run as background jobs recorded in db.jobs. Work is done in
+# batches and each finished step is recorded, so a job interrupted by a
+# restart resumes where it stopped; every batch deletes whatever still
+# matches, so repeating one is harmless. On a replica set each batch and its
+# progress update commit together in a transaction.
+#
+# A job is run by the worker holding its lease. Progress renews the lease;
+# jobs whose lease ran out (the worker died) are claimed by whichever worker
+# polls first, and a worker that finds its lease taken stops.
+CASCADE_BATCH_SIZE = int(os.getenv("CASCADE_BATCH_SIZE", "500"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+LINEUP_FIELDS = ["home_lineup", "away_lineup", "home_substitutes", "away_substitutes"]
+
+class JobLeaseLost(Exception):
+    pass
+
+class CascadeJobs:
+    def __init__(self):
+        self.owner = str(uuid.uuid4())
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.poller: Optional[asyncio.Task] = None
+        self.transactions: Optional[bool] = None
+    
+    def lease(self) -> Dict[str, Any]:
+        return {"owner": self.owner, "lease_expires": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}
+    
+    async def submit(self, kind: str, target_id: str) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        job = {
+            "id": str(uuid.uuid4()), "kind": kind, "target_id": target_id, "status": "pending",
+            "step": 0, "deleted": {}, "recount": [], "created_at": now, "updated_at": now, **self.lease(),
+        }
+        await db.jobs.insert_one(dict(job))
+        self._spawn(job)
+        return job
+    
+    def start(self):
+        self.poller = asyncio.create_task(self._poll())
+    
+    async def resume(self):
+        # Claimed one at a time so two workers never pick up the same job
+        while True:
+            lease = self.lease()
+            job = await db.jobs.find_one_and_update(
+                {"status": {"$in": ["pending", "running"]},
+                 "$or": [{"lease_expires": {"$lt": datetime.utcnow()}}, {"lease_expires": None}]},
+                {"$set": lease}, projection={"_id": 0},
+            )
+            if job is None:
+                return
+            self._spawn({**job, **lease})
     
-    for player in players:
-        stats = await db.player_stats.find_one({"player_id": player["id"]})
-        if stats:
-            stats["player_name"] = player["name"]
-            stats["squad_number"] = player["squad_number"]
-            team_stats.append(stats)
+    async def stop(self):
+        if self.poller:
+            self.poller.cancel()
+            await asyncio.gather(self.poller, return_exceptions=True)
+            self.poller = None
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Unfinished jobs stay "running"; giving up the lease lets another
+        # worker resume them straight away
+        await db.jobs.update_many({"owner": self.owner, "status": {"$in": ["pending", "running"]}},
+                                  {"$set": {"lease_expires": None}})
     
-    return team_stats
+    async def _poll(self):
+        while True:
+            try:
+                await self.resume()
+            except Exception:
+                logger.exception("Could not claim cascade delete jobs")
+            await asyncio.sleep(JOB_LEASE_SECONDS / 2)
+    
+    def _spawn(self, job: Dict[str, Any]):
+        task = asyncio.create_task(self._run(job))
+        self.tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job["id"], None))
+    
+    async def _supports_transactions(self) -> bool:
+        if self.transactions is None:
+            self.transactions = False
+            if client is not None:
+                try:
+                    hello = await client.admin.command("hello")
+                    self.transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+                except Exception:
+                    logger.exception("Could not check for transaction support")
+        return self.transactions
+    
+    async def _transact(self, operation):
+        if await self._supports_transactions():
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await operation(session)
+        else:
+            await operation(None)
+    
+    async def _progress(self, job: Dict[str, Any], update: Dict[str, Any], session=None):
+        update.setdefault("$set", {}).update(updated_at=datetime.utcnow(), **self.lease())
+        result = await db.jobs.update_one({"id": job["id"], "owner": self.owner}, update, session=session)
+        if result.matched_count == 0:
+            # Inside a transaction this also rolls the batch back
+            raise JobLeaseLost(job["id"])
+    
+    async def _renew(self, job: Dict[str, Any], runner: asyncio.Task):
+        # Keeps the lease through steps that don't report progress per batch
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await self._progress(job, {})
+            except JobLeaseLost:
+                logger.warning("Cascade delete job %s was claimed by another worker", job["id"])
+                runner.cancel()
+                return
+            except Exception:
+                logger.exception("Could not renew the lease on cascade delete job %s", job["id"])
+    
+    async def _delete_batches(self, job: Dict[str, Any], collection: str, query: Dict[str, Any],
+                              keep_players: Optional[Set[str]] = None):
+        # keep_players: events of anyone outside this set are gone, so their
+        # stats are recounted once the deletes are done
+        projection = {"_id": 1, "player_id": 1} if keep_players is not None else {"_id": 1}
+        while True:
+            docs = await db[collection].find(query, projection).limit(CASCADE_BATCH_SIZE).to_list(CASCADE_BATCH_SIZE)
+            if not docs:
+                return
+            
+            async def batch(session):
+                result = await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}},
+                                                          session=session)
+                update: Dict[str, Any] = {"$inc": {f"deleted.{collection}": result.deleted_count}}
+                if keep_players is not None:
+                    others = sorted({doc["player_id"] for doc in docs} - keep_players)
+                    if others:
+                        update["$addToSet"] = {"recount": {"$each": others}}
+                await self._progress(job, update, session)
+            await self._transact(batch)
+    
+    async def _collect(self, job: Dict[str, Any]):
+        # Pinned on the first run so a resumed job works on the same set
+        team_id = job["target_id"]
+        job["match_ids"] = await db.matches.distinct(
+            "id", {"$or": [{"home_team_id": team_id}, {"away_team_id": team_id}]})
+        job["player_ids"] = await db.players.distinct("id", {"team_id": team_id})
+        await self._progress(job, {"$set": {"match_ids": job["match_ids"], "player_ids": job["player_ids"]}})
+    
+    async def _recount(self, job: Dict[str, Any]):
+        stored = await db.jobs.find_one({"id": job["id"]}, {"_id": 0, "recount": 1})
+        player_ids = (stored or {}).get("recount", [])
+        for start in range(0, len(player_ids), CASCADE_BATCH_SIZE):
+            await recount_player_stats(player_ids[start:start + CASCADE_BATCH_SIZE])
+    
+    async def _remove_from_lineups(self, player_id: str):
+        await db.matches.update_many({"$or": [{field: player_id} for field in LINEUP_FIELDS]},
+                                     {"$pull": {field: player_id for field in LINEUP_FIELDS}})
+    
+    def _steps(self, job: Dict[str, Any]) -> List[Any]:
+        target = job["target_id"]
+        if job["kind"] == "team":
+            players, matches = job["player_ids"], job["match_ids"]
+            return [
+                lambda: self._delete_batches(job, "match_events", {"$or": [
+                    {"match_id": {"$in": matches}}, {"player_id": {"$in": players}}, {"team_id": target},
+                ]}, keep_players=set(players)),
+                lambda: self._delete_batches(job, "matches", {"id": {"$in": matches}}),
+                # Only the team's own players: anyone who has moved on keeps
+                # their row, recounted from the events that remain
+                lambda: self._delete_batches(job, "player_stats", {"player_id": {"$in": players}}),
+                lambda: self._delete_batches(job, "players", {"team_id": target}),
+                lambda: self._recount(job),
+            ]
+        return [
+            lambda: self._delete_batches(job, "match_events", {"player_id": target}),
+            lambda: self._delete_batches(job, "player_stats", {"player_id": target}),
+            lambda: self._remove_from_lineups(target),
+        ]
+    
+    async def _run(self, job: Dict[str, Any]):
+        renewer = asyncio.create_task(self._renew(job, asyncio.current_task()))
+        try:
+            await self._progress(job, {"$set": {"status": "running"}})
+            if job["kind"] == "team" and "player_ids" not in job:
+                await self._collect(job)
+            steps = self._steps(job)
+            for index in range(job["step"], len(steps)):
+                await steps[index]()
+                job["step"] = index + 1
+                await self._progress(job, {"$set": {"step": job["step"]}})
+            for match_id in job.get("match_ids", []):
+                live_matches.matches.pop(match_id, None)
+            await document_cache.invalidate("player", "player:", "team_players:")
+            await document_cache.invalidate("match", "match:")
+            await leaderboard_cache.invalidate("stats", "leaderboard:")
+            await self._progress(job, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+        except asyncio.CancelledError:
+            raise
+        except JobLeaseLost:
+            logger.warning("Cascade delete job %s was claimed by another worker", job["id"])
+        except Exception as exc:
+            logger.exception("Cascade delete job %s failed", job["id"])
+            await self._progress(job, {"$set": {"status": "failed", "error": str(exc)}})
+        finally:
+            renewer.cancel()
 
-# Helper function to update player statistics
-async def update_player_statistics(player_id: str, event_type: str):
-    stats = await db.player_stats.find_one({"player_id": player_id})
+cascade_jobs = CascadeJobs()
+
+@app.get("/api/admin/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0, "match_ids": 0, "player_ids": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Orphan sweeper: finds documents whose parent is gone. Only references the
+# API itself owns are compacted; matches may name opponents that were never
+# entered as teams, so those are reported but kept.
+ORPHAN_SWEEP_INTERVAL = float(os.getenv("ORPHAN_SWEEP_INTERVAL", "3600"))  # 0 disables
+ORPHAN_SWEEP_COMPACT = os.getenv("ORPHAN_SWEEP_COMPACT", "0") == "1"
+ORPHAN_REFERENCES = [
+    # (collection, field, referenced collection, removed when compacting)
+    ("players", "team_id", "teams", True),
+    ("player_stats", "player_id", "players", True),
+    ("match_events", "match_id", "matches", True),
+    ("matches", "home_team_id", "teams", False),
+    ("matches", "away_team_id", "teams", False),
+]
+
+orphan_documents = Gauge("orphan_documents", "Documents referencing a missing parent at the last sweep.",
+                         ("collection", "field"))
+
+async def dangling_ids(collection: str, field: str, referenced: str) -> List[Any]:
+    values = [value for value in await db[collection].distinct(field) if value not in (None, "")]
+    missing = []
+    for start in range(0, len(values), CASCADE_BATCH_SIZE):
+        chunk = values[start:start + CASCADE_BATCH_SIZE]
+        found = set(await db[referenced].distinct("id", {"id": {"$in": chunk}}))
+        missing += [value for value in chunk if value not in found]
+    return missing
+
+async def delete_in_chunks(collection: str, field: str, values: List[Any]) -> int:
+    deleted = 0
+    for start in range(0, len(values), CASCADE_BATCH_SIZE):
+        result = await db[collection].delete_many({field: {"$in": values[start:start + CASCADE_BATCH_SIZE]}})
+        deleted += result.deleted_count
+    return deleted
+
+async def sweep_orphans(compact: bool = False) -> Dict[str, Any]:
+    report = []
+    for collection, field, referenced, removable in ORPHAN_REFERENCES:
+        missing = await dangling_ids(collection, field, referenced)
+        documents = 0
+        for start in range(0, len(missing), CASCADE_BATCH_SIZE):
+            documents += await db[collection].count_documents(
+                {field: {"$in": missing[start:start + CASCADE_BATCH_SIZE]}})
+        deleted = await delete_in_chunks(collection, field, missing) if compact and removable else 0
+        orphan_documents.set(collection, field, value=documents - deleted)
+        report.append({"collection": collection, "field": field, "references": referenced,
+                       "dangling_ids": len(missing), "documents": documents, "deleted": deleted})
+
+    # Media no team logo or player photo points at any more
+    used = set(await db.teams.distinct("logo_hash")) | set(await db.players.distinct("photo_hash"))
+    unused = [digest for digest in await db.media.distinct("hash") if digest not in used]
+    deleted = await delete_in_chunks("media", "hash", unused) if compact else 0
+    orphan_documents.set("media", "hash", value=len(unused) - deleted)
+    report.append({"collection": "media", "field": "hash", "references": "teams.logo_hash, players.photo_hash",
+                   "dangling_ids": len(unused), "documents": len(unused), "deleted": deleted})
+
+    if compact:
+        await document_cache.invalidate("player", "player:", "team_players:")
+        await leaderboard_cache.invalidate("stats", "leaderboard:")
+    return {"compacted": compact, "references": report}
+
+class OrphanSweeper:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
     
-    if not stats:
-        player = await db.players.find_one({"id": player_id})
-        stats = PlayerStats(player_id=player_id, team_id=player["team_id"])
-        stats_dict = stats.dict()
-    else:
-        stats_dict = stats
-    
-    # Update based on event type
-    if event_type == "goal":
-        stats_dict["goals"] += 1
-    elif event_type == "assist":
-        stats_dict["assists"] += 1
-    elif event_type == "player_of_match":
-        stats_dict["player_of_match_awards"] += 1
-    elif event_type == "yellow_card":
-        stats_dict["yellow_cards"] += 1
-    elif event_type == "red_card":
-        stats_dict["red_cards"] += 1
-    
-    await db.player_stats.replace_one(
-        {"player_id": player_id}, 
-        stats_dict, 
-        upsert=True
-    )
+    def start(self):
+        if ORPHAN_SWEEP_INTERVAL > 0:
+            self.task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(ORPHAN_SWEEP_INTERVAL)
+            try:
+                result = await sweep_orphans(ORPHAN_SWEEP_COMPACT)
+                found = sum(entry["documents"] for entry in result["references"])
+                if found:
+                    logger.warning("Orphan sweep found %d dangling documents", found)
+            except Exception:
+                logger.exception("Orphan sweep failed")
+
+orphan_sweeper = OrphanSweeper()
+
+@app.get("/api/admin/orphans")
+async def get_orphans():
+    return await sweep_orphans(compact=False)
+
+@app.post("/api/admin/orphans/sweep")
+async def post_sweep_orphans(compact: bool = True):
+    return await sweep_orphans(compact)
+
+# Streaming export/import. Each NDJSON line is {"collection": ..., "doc": ...}
+# in MongoDB relaxed extended JSON, so dates and binary media survive the
+# round trip. Memory use stays constant: export reads from cursors and import
+# writes in batches as lines arrive.
+EXPORT_COLLECTIONS = {
+    "teams": "id",
+    "players": "id",
+    "formations": "name",
+    "matches": "id",
+    "match_events": "id",
+    "player_stats": "player_id",
+    "media": "hash",
+}
+IMPORT_BATCH_SIZE = 500
+
+def parse_collections(collections: Optional[str]) -> List[str]:
+    if not collections:
+        return list(EXPORT_COLLECTIONS)
+    requested = [c.strip() for c in collections.split(",") if c.strip()]
+    unknown = [c for c in requested if c not in EXPORT_COLLECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown collections: {', '.join(unknown)}")
+    return requested
+
+async def export_lines(collections: List[str]):
+    for name in collections:
+        async for doc in db[name].find({}, {"_id": 0}).batch_size(IMPORT_BATCH_SIZE):
+            yield (json_util.dumps({"collection": name, "doc": doc}, json_options=RELAXED_JSON_OPTIONS) + "\n").encode()
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def ndjson_lines(chunks):
+    # Accepts plain or gzip-compressed bytes and yields one line at a time.
+    # The gzip magic may arrive split across chunks, so the first two bytes
+    # are buffered before deciding.
+    decompressor = None
+    head = b""
+    pending = b""
+    async for chunk in chunks:
+        if decompressor is None:
+            head += chunk
+            if len(head) < 2:
+                continue
+            decompressor = zlib.decompressobj(47) if head[:2] == b"\x1f\x8b" else False
+            chunk, head = head, b""
+        pending += decompressor.decompress(chunk) if decompressor else chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    pending += decompressor.flush() if decompressor else head
+    for line in pending.split(b"\n"):
+        if line.strip():
+            yield line
+
+async def import_lines(lines) -> Dict[str, Any]:
+    batches: Dict[str, List[ReplaceOne]] = {}
+    counts: Dict[str, int] = {}
+    errors: List[Dict[str, Any]] = []
+
+    async def flush(name: str):
+        result = await db[name].bulk_write(batches.pop(name), ordered=False)
+        counts[name] = counts.get(name, 0) + result.upserted_count + result.modified_count
+
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        try:
+            record = json_util.loads(line, json_options=RELAXED_JSON_OPTIONS)
+            name, doc = record["collection"], record["doc"]
+            key = EXPORT_COLLECTIONS[name]
+            doc.pop("_id", None)
+            # Upsert on the natural key so re-running an import is harmless
+            operation = ReplaceOne({key: doc[key]}, doc, upsert=True)
+        except (ValueError, KeyError, TypeError) as exc:
+            if len(errors) < 100:
+                errors.append({"line": line_number, "error": str(exc)})
+            continue
+        batches.setdefault(name, []).append(operation)
+        if len(batches[name]) >= IMPORT_BATCH_SIZE:
+            await flush(name)
+    for name in list(batches):
+        await flush(name)
+
+    document_cache.clear()
+    await leaderboard_cache.invalidate("stats", "leaderboard:")
+    await formation_cache.reload()
+    return {"lines": line_number, "written": counts, "errors": errors}
+
+@app.get("/api/export")
+async def export_data(collections: Optional[str] = None, compress: bool = False):
+    lines = export_lines(parse_collections(collections))
+    if compress:
+        return StreamingResponse(gzip_stream(lines), media_type="application/gzip",
+                                 headers={"Content-Disposition": 'attachment; filename="export.ndjson.gz"'})
+    return StreamingResponse(lines, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="export.ndjson"'})
+
+@app.post("/api/import")
+async def import_data(request: Request):
+    return await import_lines(ndjson_lines(request.stream()))
 
 # WebSocket endpoint for real-time updates
+async def match_snapshot(match_id: str) -> Dict[str, Any]:
+    # Read the sequence first: anything published after this point arrives as
+    # a normal delta with a higher seq, so clients can discard seq <= snapshot
+    seq = await match_sequencer.current_seq(match_id)
+    live = live_matches.get(match_id)
+    if live is not None:
+        match, events = live.match, live.events
+    else:
+        match = await db.matches.find_one({"id": match_id}, {"_id": 0})
+        events = await db.match_events.find({"match_id": match_id}, {"_id": 0}).sort("minute", 1).to_list(length=None)
+    return {"type": "snapshot", "match_id": match_id, "seq": seq, "match": match, "events": events}
+
+async def replay_since(websocket: WebSocket, topics: List[str], since: int):
+    for topic in topics:
+        if not topic.startswith("match:"):
+            continue
+        match_id = topic[len("match:"):]
+        connection = manager.active_connections.get(websocket)
+        if connection is None:
+            return
+        missed = match_sequencer.since(match_id, since)
+        # Queued in one go, so a replay longer than the free queue space would
+        # overflow and lose deltas without the client knowing
+        free = connection.queue.maxsize - connection.queue.qsize()
+        if missed is None or len(missed) > free:
+            # Too far behind for the ring buffer: send the full state instead
+            messages = [dump_json(await match_snapshot(match_id)).decode()]
+        else:
+            messages = missed
+        for message in messages:
+            await manager.send_personal_message(message, websocket)
+
+def parse_since(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    # Topics can be given up front (?topics=match:abc,team:xyz&since=12) or
+    # changed later with {"action": "subscribe"|"unsubscribe", "topics": [...],
+    # "since": 12}. Match deltas are JSON with a per-match "seq"; since replays
+    # whatever came after that seq.
+    topics = [t for t in websocket.query_params.get("topics", "").split(",") if t]
+    await manager.connect(websocket, topics)
+    since = parse_since(websocket.query_params.get("since"))
+    if since is not None:
+        await replay_since(websocket, topics, since)
     try:
         while True:
             data = await websocket.receive_text()
-            await manager.send_personal_message(f"Message: {data}", websocket)
+            try:
+                command = json.loads(data)
+            except ValueError:
+                command = None
+            if isinstance(command, dict) and command.get("action") in ("subscribe", "unsubscribe"):
+                connection = manager.active_connections.get(websocket)
+                if connection is None:
+                    # The sender dropped this socket as too slow and is closing it
+                    break
+                requested = [t for t in command.get("topics", []) if isinstance(t, str)]
+                if command["action"] == "subscribe":
+                    manager.subscribe(websocket, requested)
+                else:
+                    manager.unsubscribe(websocket, requested)
+                await manager.send_personal_message(json.dumps({"topics": sorted(connection.topics)}), websocket)
+                since = parse_since(command.get("since"))
+                if command["action"] == "subscribe" and since is not None:
+                    await replay_since(websocket, requested, since)
+            else:
+                await manager.send_personal_message(f"Message: {data}", websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
+async def check_indexes() -> int:
+    if STORAGE_BACKEND != "mongo":
+        print("check-indexes needs STORAGE_BACKEND=mongo", file=sys.stderr)
+        return 2
+    await ensure_indexes()
+    report = await index_report()
+    for entry in report:
+        flag = "COLLSCAN" if entry["collscan"] else "ok"
+        print(f"{flag:<9} {entry['route']:<32} {' > '.join(entry['stages'])}")
+    return 1 if any(entry["collscan"] for entry in report) else 0
+
+async def run_export(path: str, collections: Optional[str]) -> int:
+    lines = export_lines(parse_collections(collections))
+    chunks = gzip_stream(lines) if path.endswith(".gz") else lines
+    with open(path, "wb") as out:
+        async for chunk in chunks:
+            out.write(chunk)
+    return 0
+
+async def file_chunks(path: str, size: int = 64 * 1024):
+    with open(path, "rb") as source:
+        while True:
+            chunk = source.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+async def run_import(path: str) -> int:
+    summary = await import_lines(ndjson_lines(file_chunks(path)))
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+async def run_rebuild_stats(since: Optional[datetime], incremental: bool) -> int:
+    summary = await rebuild_player_stats(since, incremental)
+    print(json.dumps(summary, default=str, indent=2))
+    return 0
+
+async def run_sweep_orphans(compact: bool) -> int:
+    summary = await sweep_orphans(compact)
+    print(json.dumps(summary, default=str, indent=2))
+    return 0
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Grassroots Match Tracker API")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="run the API server (default)")
+    commands.add_parser("check-indexes", help="report route queries that fall back to a COLLSCAN")
+    rebuild = commands.add_parser("rebuild-stats", help="recompute player stats from match events")
+    rebuild.add_argument("--since", type=datetime.fromisoformat, help="only players with events stored at or after this time (UTC)")
+    rebuild.add_argument("--incremental", action="store_true", help="continue from the last rebuild's watermark")
+    export = commands.add_parser("export", help="write collections as NDJSON (gzip if the path ends in .gz)")
+    export.add_argument("path")
+    export.add_argument("--collections", help="comma separated, defaults to all")
+    import_ = commands.add_parser("import", help="load an NDJSON or gzip NDJSON export")
+    import_.add_argument("path")
+    sweep = commands.add_parser("sweep-orphans", help="report documents whose parent team, player or match is gone")
+    sweep.add_argument("--compact", action="store_true", help="delete the orphans instead of only reporting them")
+    args = parser.parse_args()
+
+    if args.command == "check-indexes":
+        sys.exit(asyncio.run(check_indexes()))
+    elif args.command == "rebuild-stats":
+        sys.exit(asyncio.run(run_rebuild_stats(args.since, args.incremental)))
+    elif args.command == "export":
+        sys.exit(asyncio.run(run_export(args.path, args.collections)))
+    elif args.command == "import":
+        sys.exit(asyncio.run(run_import(args.path)))
+    elif args.command == "sweep-orphans":
+        sys.exit(asyncio.run(run_sweep_orphans(args.compact)))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,699 @@
+# In-process document store for single-club installs, tests and benchmarks.
+# It implements the part of the motor collection API that server.py uses, so
+# routes run unchanged against either backend. Documents live in memory;
+# with a path they are also written through to SQLite and reloaded on start.
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId, json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateMany
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+MISSING = object()
+
+def copy_value(value: Any) -> Any:
+    # Stored values are JSON-like; everything but dicts and lists is immutable
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+def get_path(doc: Any, path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return MISSING
+        doc = doc[part]
+    return doc
+
+def set_path(doc: Dict[str, Any], path: str, value: Any):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def unset_path(doc: Dict[str, Any], path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+# BSON comparison order across types, enough for sorting and range queries
+def type_rank(value: Any) -> int:
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+class SortKey:
+    __slots__ = ("rank", "value")
+
+    def __init__(self, value: Any):
+        self.rank = type_rank(value)
+        self.value = None if self.rank in (1, 4, 5) else value
+
+    def __lt__(self, other: "SortKey") -> bool:
+        if self.rank != other.rank:
+            return self.rank < other.rank
+        return self.value is not None and self.value < other.value
+
+    def __eq__(self, other: "SortKey") -> bool:
+        return self.rank == other.rank and self.value == other.value
+
+def compare(value: Any, target: Any, op: str) -> bool:
+    if value is MISSING or type_rank(value) != type_rank(target):
+        return False
+    try:
+        if op == "$gt":
+            return value > target
+        if op == "$gte":
+            return value >= target
+        if op == "$lt":
+            return value < target
+        return value <= target
+    except TypeError:
+        return False
+
+def values_equal(value: Any, target: Any) -> bool:
+    if value is MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+def condition_matches(value: Any, condition: Any) -> bool:
+    if not (isinstance(condition, dict) and condition and next(iter(condition)).startswith("$")):
+        return values_equal(value, condition)
+    for op, target in condition.items():
+        if op == "$eq":
+            matched = values_equal(value, target)
+        elif op == "$ne":
+            matched = not values_equal(value, target)
+        elif op == "$in":
+            matched = any(values_equal(value, item) for item in target)
+        elif op == "$nin":
+            matched = not any(values_equal(value, item) for item in target)
+        elif op == "$exists":
+            matched = (value is not MISSING) == bool(target)
+        elif op in ("$gt", "$gte", "$lt", "$lte"):
+            candidates = value if isinstance(value, list) else [value]
+            matched = any(compare(item, target, op) for item in candidates)
+        else:
+            raise OperationFailure(f"Unsupported query operator {op}")
+        if not matched:
+            return False
+    return True
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    for field, condition in (query or {}).items():
+        if field == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif field == "$nor":
+            if any(matches(doc, clause) for clause in condition):
+                return False
+        elif not condition_matches(get_path(doc, field), condition):
+            return False
+    return True
+
+def project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return copy_value(doc)
+    include_id = bool(projection.get("_id", 1))
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+    if fields and all(fields.values()):
+        result = {}
+        if include_id and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for field in fields:
+            value = get_path(doc, field)
+            if value is not MISSING:
+                set_path(result, field, copy_value(value))
+        return result
+    result = copy_value(doc)
+    for field in fields:
+        unset_path(result, field)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+def normalize_sort(key_or_list, direction=None) -> List[tuple]:
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+def sort_docs(docs: List[Dict[str, Any]], spec: List[tuple]) -> List[Dict[str, Any]]:
+    # Stable sorts applied from the least significant key up
+    for field, direction in reversed(spec):
+        docs.sort(key=lambda doc: SortKey(get_path(doc, field)), reverse=direction < 0)
+    return docs
+
+def apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool = False):
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        for field, value in fields.items():
+            if op in ("$set", "$setOnInsert"):
+                set_path(doc, field, copy_value(value))
+            elif op == "$unset":
+                unset_path(doc, field)
+            elif op == "$inc":
+                current = get_path(doc, field)
+                set_path(doc, field, (0 if current in (MISSING, None) else current) + value)
+            elif op in ("$max", "$min"):
+                current = get_path(doc, field)
+                if current is MISSING or (value > current if op == "$max" else value < current):
+                    set_path(doc, field, value)
+            elif op in ("$addToSet", "$push"):
+                items = get_path(doc, field)
+                if items is MISSING:
+                    items = []
+                    set_path(doc, field, items)
+                additions = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in additions:
+                    if op == "$push" or item not in items:
+                        items.append(copy_value(item))
+            elif op == "$pull":
+                items = get_path(doc, field)
+                if isinstance(items, list):
+                    items[:] = [item for item in items if not condition_matches(item, value)]
+            else:
+                raise OperationFailure(f"Unsupported update operator {op}")
+
+def upsert_seed(query: Dict[str, Any]) -> Dict[str, Any]:
+    # Equality conditions of the filter become fields of the inserted document
+    doc: Dict[str, Any] = {}
+    for field, condition in query.items():
+        if field.startswith("$"):
+            continue
+        if isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+            if "$eq" in condition:
+                set_path(doc, field, copy_value(condition["$eq"]))
+            continue
+        set_path(doc, field, copy_value(condition))
+    return doc
+
+# Aggregation expressions and stages used by the stats and leaderboard pipelines
+def evaluate(expression: Any, doc: Dict[str, Any]) -> Any:
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(doc, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, dict) and len(expression) == 1 and next(iter(expression)).startswith("$"):
+        op, args = next(iter(expression.items()))
+        if op == "$cond":
+            if isinstance(args, dict):
+                args = [args["if"], args["then"], args["else"]]
+            return evaluate(args[1] if evaluate(args[0], doc) else args[2], doc)
+        if op == "$eq":
+            return evaluate(args[0], doc) == evaluate(args[1], doc)
+        if op == "$ne":
+            return evaluate(args[0], doc) != evaluate(args[1], doc)
+        if op == "$ifNull":
+            value = evaluate(args[0], doc)
+            return evaluate(args[1], doc) if value is None else value
+        if op == "$literal":
+            return args
+        raise OperationFailure(f"Unsupported expression operator {op}")
+    if isinstance(expression, dict):
+        return {key: evaluate(value, doc) for key, value in expression.items()}
+    return expression
+
+def group(docs: List[Dict[str, Any]], spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    groups: Dict[Any, Dict[str, Any]] = {}
+    for doc in docs:
+        key = evaluate(spec["_id"], doc)
+        hashable = json_util.dumps(key, sort_keys=True) if isinstance(key, (dict, list)) else key
+        row = groups.get(hashable)
+        if row is None:
+            row = groups[hashable] = {"_id": key}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            op, expression = next(iter(accumulator.items()))
+            value = evaluate(expression, doc)
+            if op == "$sum":
+                row[field] = row.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif op == "$first":
+                row.setdefault(field, value)
+            elif op == "$last":
+                row[field] = value
+            elif op == "$max":
+                row[field] = value if field not in row or SortKey(row[field]) < SortKey(value) else row[field]
+            elif op == "$min":
+                row[field] = value if field not in row or SortKey(value) < SortKey(row[field]) else row[field]
+            elif op in ("$push", "$addToSet"):
+                items = row.setdefault(field, [])
+                if op == "$push" or value not in items:
+                    items.append(value)
+            else:
+                raise OperationFailure(f"Unsupported accumulator {op}")
+    return list(groups.values())
+
+def project_stage(doc: Dict[str, Any], spec: Dict[str, Any]) -> Dict[str, Any]:
+    if all(value in (0, False) for value in spec.values()):
+        return project(doc, spec)
+    result: Dict[str, Any] = {}
+    if spec.get("_id", 1) not in (0, False) and "_id" in doc:
+        result["_id"] = doc["_id"]
+    for field, value in spec.items():
+        if field == "_id" and value in (0, False, 1, True):
+            continue
+        if value in (1, True):
+            current = get_path(doc, field)
+            if current is not MISSING:
+                set_path(result, field, current)
+        else:
+            set_path(result, field, evaluate(value, doc))
+    return result
+
+class MemoryCursor:
+    def __init__(self, collection: "MemoryCollection", query: Optional[Dict[str, Any]] = None,
+                 projection: Optional[Dict[str, Any]] = None, **kwargs):
+        if kwargs.get("cursor_type"):
+            raise OperationFailure("Tailable cursors need the mongo storage backend")
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self.sort_spec: List[tuple] = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results: Optional[List[Dict[str, Any]]] = None
+        self.position = 0
+
+    def sort(self, key_or_list, direction=None):
+        self.sort_spec = normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, count: int):
+        self.skip_count = count
+        return self
+
+    def limit(self, count: int):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def hint(self, index):
+        return self
+
+    async def explain(self) -> Dict[str, Any]:
+        raise OperationFailure("Query plans are only available on the mongo storage backend")
+
+    def _evaluate(self) -> List[Dict[str, Any]]:
+        docs = sort_docs(self.collection._scan(self.query), self.sort_spec)
+        docs = docs[self.skip_count:]
+        if self.limit_count:
+            docs = docs[:self.limit_count]
+        return [project(doc, self.projection) for doc in docs]
+
+    def _remaining(self) -> List[Dict[str, Any]]:
+        if self.results is None:
+            self.results = self._evaluate()
+            self.position = 0
+        return self.results
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        results = self._remaining()
+        end = len(results) if not length else self.position + length
+        docs = results[self.position:end]
+        self.position += len(docs)
+        return docs
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        results = self._remaining()
+        if self.position >= len(results):
+            raise StopAsyncIteration
+        self.position += 1
+        return results[self.position - 1]
+
+class AggregateCursor(MemoryCursor):
+    def __init__(self, collection: "MemoryCollection", pipeline: List[Dict[str, Any]]):
+        super().__init__(collection)
+        self.pipeline = pipeline
+
+    def _evaluate(self) -> List[Dict[str, Any]]:
+        database = self.collection.database
+        docs = [copy_value(doc) for doc in self.collection.documents.values()]
+        for stage in self.pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif name == "$sort":
+                docs = sort_docs(docs, normalize_sort(spec))
+            elif name == "$limit":
+                docs = docs[:spec]
+            elif name == "$skip":
+                docs = docs[spec:]
+            elif name == "$project":
+                docs = [project_stage(doc, spec) for doc in docs]
+            elif name == "$group":
+                docs = group(docs, spec)
+            elif name == "$replaceRoot":
+                docs = [evaluate(spec["newRoot"], doc) for doc in docs]
+            elif name == "$unwind":
+                path = (spec if isinstance(spec, str) else spec["path"])[1:]
+                unwound = []
+                for doc in docs:
+                    value = get_path(doc, path)
+                    for item in value if isinstance(value, list) else ([] if value in (MISSING, None) else [value]):
+                        row = dict(doc)
+                        set_path(row, path, item)
+                        unwound.append(row)
+                docs = unwound
+            elif name == "$lookup":
+                foreign = database[spec["from"]]
+                for doc in docs:
+                    local = get_path(doc, spec["localField"])
+                    local = None if local is MISSING else local
+                    doc[spec["as"]] = [copy_value(match) for match in foreign._scan({spec["foreignField"]: local})]
+            else:
+                raise OperationFailure(f"Unsupported aggregation stage {name}")
+        return docs
+
+class MemoryCollection:
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self.documents: Dict[Any, Dict[str, Any]] = {}
+        # Unique single-field indexes double as lookup tables for equality queries
+        self.unique: Dict[tuple, Dict[Any, Any]] = {}
+
+    # Reads
+    def _candidates(self, query: Dict[str, Any]):
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self.documents.get(query["_id"])
+            return [doc] if doc is not None else []
+        for keys, entries in self.unique.items():
+            if len(keys) == 1 and keys[0] in query and not isinstance(query[keys[0]], (dict, list)):
+                doc_id = entries.get((query[keys[0]],))
+                return [self.documents[doc_id]] if doc_id is not None else []
+        return self.documents.values()
+
+    def _scan(self, query: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        query = query or {}
+        return [doc for doc in self._candidates(query) if matches(doc, query)]
+
+    def find(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None, **kwargs):
+        cursor = MemoryCursor(self, filter, projection, **kwargs)
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        return cursor
+
+    async def find_one(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None,
+                       sort=None, **kwargs) -> Optional[Dict[str, Any]]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        docs = self._scan(filter)
+        if sort:
+            docs = sort_docs(docs, normalize_sort(sort))
+        return project(docs[0], projection) if docs else None
+
+    async def count_documents(self, filter: Dict[str, Any], limit: int = 0, skip: int = 0, **kwargs) -> int:
+        count = max(0, len(self._scan(filter)) - skip)
+        return min(count, limit) if limit else count
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        return len(self.documents)
+
+    async def distinct(self, key: str, filter: Optional[Dict[str, Any]] = None, **kwargs) -> List[Any]:
+        values: List[Any] = []
+        for doc in self._scan(filter):
+            value = get_path(doc, key)
+            for item in value if isinstance(value, list) else [value]:
+                if item is not MISSING and item not in values:
+                    values.append(item)
+        return values
+
+    def aggregate(self, pipeline: List[Dict[str, Any]], **kwargs):
+        return AggregateCursor(self, pipeline)
+
+    # Writes
+    def _index_keys(self, keys: tuple, doc: Dict[str, Any]) -> tuple:
+        return tuple(None if (value := get_path(doc, key)) is MISSING else value for key in keys)
+
+    def _check_unique(self, doc: Dict[str, Any], doc_id: Any = MISSING):
+        if doc_id is MISSING and doc.get("_id") in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_", 11000)
+        for keys, entries in self.unique.items():
+            owner = entries.get(self._index_keys(keys, doc), MISSING)
+            if owner is not MISSING and owner != doc_id:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} index: {'_'.join(keys)}", 11000)
+
+    def _store(self, doc: Dict[str, Any], previous: Optional[Dict[str, Any]] = None):
+        for keys, entries in self.unique.items():
+            if previous is not None:
+                entries.pop(self._index_keys(keys, previous), None)
+            entries[self._index_keys(keys, doc)] = doc["_id"]
+        self.documents[doc["_id"]] = doc
+        self.database._persist(self.name, doc)
+
+    def _remove(self, doc: Dict[str, Any]):
+        for keys, entries in self.unique.items():
+            entries.pop(self._index_keys(keys, doc), None)
+        del self.documents[doc["_id"]]
+        self.database._forget(self.name, doc["_id"])
+
+    def _insert(self, document: Dict[str, Any]) -> Any:
+        # Like pymongo, an _id is added to the caller's dict
+        document.setdefault("_id", ObjectId())
+        doc = copy_value(document)
+        self._check_unique(doc)
+        self._store(doc)
+        return doc["_id"]
+
+    def _update(self, filter: Dict[str, Any], update: Any, upsert: bool, many: bool, replace: bool):
+        targets = self._scan(filter)
+        if not many:
+            targets = targets[:1]
+        modified = 0
+        for previous in targets:
+            doc = copy_value(previous)
+            if replace:
+                doc = {"_id": previous["_id"], **copy_value(update)}
+            else:
+                apply_update(doc, update)
+            if doc != previous:
+                self._check_unique(doc, previous["_id"])
+                self._store(doc, previous)
+                modified += 1
+        upserted_id = None
+        if not targets and upsert:
+            doc = upsert_seed(filter)
+            if replace:
+                doc.update(copy_value(update))
+            else:
+                apply_update(doc, update, inserting=True)
+            upserted_id = self._insert(doc)
+        return len(targets), modified, upserted_id
+
+    async def insert_one(self, document: Dict[str, Any], **kwargs) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(self, documents: List[Dict[str, Any]], ordered: bool = True, **kwargs) -> InsertManyResult:
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted.append(self._insert(document))
+            except DuplicateKeyError as exc:
+                errors.append({"index": index, "code": 11000, "errmsg": str(exc), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted), "writeConcernErrors": [],
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(inserted, True)
+
+    async def update_one(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False,
+                         **kwargs) -> UpdateResult:
+        matched, modified, upserted_id = self._update(filter, update, upsert, many=False, replace=False)
+        return update_result(matched, modified, upserted_id)
+
+    async def update_many(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False,
+                          **kwargs) -> UpdateResult:
+        matched, modified, upserted_id = self._update(filter, update, upsert, many=True, replace=False)
+        return update_result(matched, modified, upserted_id)
+
+    async def replace_one(self, filter: Dict[str, Any], replacement: Dict[str, Any], upsert: bool = False,
+                          **kwargs) -> UpdateResult:
+        matched, modified, upserted_id = self._update(filter, replacement, upsert, many=False, replace=True)
+        return update_result(matched, modified, upserted_id)
+
+    async def find_one_and_update(self, filter: Dict[str, Any], update: Dict[str, Any],
+                                  projection: Optional[Dict[str, Any]] = None, sort=None, upsert: bool = False,
+                                  return_document=ReturnDocument.BEFORE, **kwargs) -> Optional[Dict[str, Any]]:
+        docs = self._scan(filter)
+        if sort:
+            docs = sort_docs(docs, normalize_sort(sort))
+        if not docs:
+            if not upsert:
+                return None
+            _, _, upserted_id = self._update(filter, update, True, many=False, replace=False)
+            return project(self.documents[upserted_id], projection) if return_document else None
+        previous = docs[0]
+        self._update({"_id": previous["_id"]}, update, False, many=False, replace=False)
+        return project(self.documents[previous["_id"]] if return_document else previous, projection)
+
+    async def delete_one(self, filter: Dict[str, Any], **kwargs) -> DeleteResult:
+        docs = self._scan(filter)[:1]
+        for doc in docs:
+            self._remove(doc)
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def delete_many(self, filter: Dict[str, Any], **kwargs) -> DeleteResult:
+        docs = self._scan(filter)
+        for doc in docs:
+            self._remove(doc)
+        return DeleteResult({"n": len(docs)}, True)
+
+    async def bulk_write(self, requests: List[Any], ordered: bool = True, **kwargs) -> BulkWriteResult:
+        result = {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+                  "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result["nInserted"] += 1
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    docs = self._scan(request._filter)
+                    for doc in docs if isinstance(request, DeleteMany) else docs[:1]:
+                        self._remove(doc)
+                        result["nRemoved"] += 1
+                else:
+                    matched, modified, upserted_id = self._update(
+                        request._filter, request._doc, bool(request._upsert),
+                        many=isinstance(request, UpdateMany), replace=isinstance(request, ReplaceOne))
+                    result["nMatched"] += matched
+                    result["nModified"] += modified
+                    if upserted_id is not None:
+                        result["nUpserted"] += 1
+                        result["upserted"].append({"index": index, "_id": upserted_id})
+            except DuplicateKeyError as exc:
+                result["writeErrors"].append({"index": index, "code": 11000, "errmsg": str(exc)})
+                if ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    # Indexes only matter for uniqueness here; scans are cheap at club scale
+    async def create_indexes(self, indexes: List[Any], **kwargs) -> List[str]:
+        names = []
+        for index in indexes:
+            document = index.document
+            keys = tuple(document["key"].keys())
+            if document.get("unique") and keys not in self.unique:
+                entries: Dict[tuple, Any] = {}
+                for doc in self.documents.values():
+                    key = self._index_keys(keys, doc)
+                    if key in entries:
+                        raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}", 11000)
+                    entries[key] = doc["_id"]
+                self.unique[keys] = entries
+            names.append(document["name"])
+        return names
+
+    async def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        from pymongo import IndexModel
+        return (await self.create_indexes([IndexModel(keys, unique=unique, **kwargs)]))[0]
+
+    async def drop(self):
+        for doc_id in list(self.documents):
+            self.database._forget(self.name, doc_id)
+        self.documents.clear()
+        for entries in self.unique.values():
+            entries.clear()
+
+def update_result(matched: int, modified: int, upserted_id: Any) -> UpdateResult:
+    raw = {"n": matched or (1 if upserted_id is not None else 0), "nModified": modified}
+    if upserted_id is not None:
+        raw["upserted"] = upserted_id
+    return UpdateResult(raw, True)
+
+class MemoryDatabase:
+    def __init__(self, path: Optional[str] = None):
+        self.collections: Dict[str, MemoryCollection] = {}
+        self.connection: Optional[sqlite3.Connection] = None
+        if path:
+            # Opened at import but used from the event loop's thread; all
+            # access is still serialized through that one loop
+            self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents "
+                "(collection TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, PRIMARY KEY (collection, id))"
+            )
+            for name, body in self.connection.execute("SELECT collection, body FROM documents"):
+                doc = json_util.loads(body, json_options=RELAXED_JSON_OPTIONS)
+                self[name].documents[doc["_id"]] = doc
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = MemoryCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def create_collection(self, name: str, **kwargs) -> MemoryCollection:
+        if name in self.collections:
+            raise CollectionInvalid(f"collection {name} already exists")
+        return self[name]
+
+    async def list_collection_names(self, **kwargs) -> List[str]:
+        return [name for name, collection in self.collections.items() if collection.documents]
+
+    async def drop_collection(self, name: str):
+        await self[name].drop()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # Write-through persistence, keyed by the JSON form of _id
+    def _persist(self, name: str, doc: Dict[str, Any]):
+        if self.connection is not None:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (collection, id, body) VALUES (?, ?, ?)",
+                (name, json_util.dumps(doc["_id"]), json_util.dumps(doc, json_options=RELAXED_JSON_OPTIONS)),
+            )
+
+    def _forget(self, name: str, doc_id: Any):
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM documents WHERE collection = ? AND id = ?",
+                                    (name, json_util.dumps(doc_id)))
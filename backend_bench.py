@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+import websockets
+
+# Matchday benchmark: starts server.app against a local mongod in a scratch
+# database, then runs N live matches posting events, M WebSocket spectators
+# per match and dashboards polling stats. Results are written as JSON so runs
+# can be compared across commits.
+#
+#   python backend_bench.py --matches 8 --spectators 25 --duration 60
+#   python backend_bench.py --output results/$(git rev-parse --short HEAD).json
+#   python backend_bench.py --storage memory   # no mongod, zero-latency store
+
+EVENT_TYPES = ["goal", "assist", "yellow_card", "red_card", "substitution", "player_of_match"]
+EVENT_WEIGHTS = [3, 2, 3, 1, 2, 1]
+PLAYERS_PER_TEAM = 11
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+def rss_mb(pid):
+    # Linux only; other platforms report no memory figures
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.broadcast_lag = []
+        self.broadcasts_received = 0
+        self.events_sent = 0
+
+    async def request(self, http, route, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            return None
+        self.latencies[route].append(round((time.perf_counter() - started) * 1000, 3))
+        if response.status_code >= 400:
+            self.errors[route] += 1
+            return None
+        return response
+
+    def routes(self):
+        return {
+            route: {**summarize(values), "errors": self.errors.get(route, 0)}
+            for route, values in sorted(self.latencies.items())
+        }
+
+async def setup_fixtures(http, recorder, matches):
+    fixtures = []
+    for index in range(matches):
+        teams = []
+        for side in ("Home", "Away"):
+            response = await recorder.request(http, "POST /api/teams", "POST", "/api/teams",
+                                              json={"name": f"Bench {side} {index}"})
+            team = response.json()
+            players = []
+            for number in range(1, PLAYERS_PER_TEAM + 1):
+                response = await recorder.request(http, "POST /api/players", "POST", "/api/players", json={
+                    "team_id": team["id"], "name": f"{side} {index} #{number}",
+                    "squad_number": number, "position": "MID",
+                })
+                players.append(response.json()["id"])
+            teams.append({"id": team["id"], "players": players})
+        response = await recorder.request(http, "POST /api/matches", "POST", "/api/matches", json={
+            "home_team_id": teams[0]["id"], "away_team_id": teams[1]["id"],
+            "match_type": "League", "match_date": datetime.utcnow().isoformat(), "venue": "Bench Park",
+        })
+        fixtures.append({"match_id": response.json()["id"], "teams": teams})
+    return fixtures
+
+async def live_match(http, recorder, fixture, rate, deadline):
+    minute = 0
+    while time.time() < deadline:
+        team = random.choice(fixture["teams"])
+        event = {
+            "match_id": fixture["match_id"],
+            "event_type": random.choices(EVENT_TYPES, EVENT_WEIGHTS)[0],
+            "player_id": random.choice(team["players"]),
+            "team_id": team["id"],
+            "minute": min(minute, 90),
+            "additional_data": {"bench_sent_at": time.time()},
+        }
+        if await recorder.request(http, "POST /api/match-events", "POST", "/api/match-events", json=event):
+            recorder.events_sent += 1
+        minute += 1
+        await asyncio.sleep(random.expovariate(rate))
+
+async def spectator(ws_url, recorder, match_id, deadline, ready):
+    try:
+        async with websockets.connect(f"{ws_url}/ws?topics=match:{match_id}", max_queue=None) as websocket:
+            ready.release()
+            while time.time() < deadline:
+                try:
+                    raw = await asyncio.wait_for(websocket.recv(), timeout=max(0.1, deadline - time.time()))
+                except asyncio.TimeoutError:
+                    break
+                received_at = time.time()
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    continue
+                if not isinstance(message, dict) or message.get("type") != "event":
+                    continue
+                recorder.broadcasts_received += 1
+                sent_at = ((message.get("event") or {}).get("additional_data") or {}).get("bench_sent_at")
+                if sent_at:
+                    recorder.broadcast_lag.append(round((received_at - sent_at) * 1000, 3))
+    except (OSError, websockets.WebSocketException):
+        recorder.errors["WS /ws"] += 1
+        ready.release()
+
+async def dashboard(http, recorder, fixtures, interval, deadline):
+    while time.time() < deadline:
+        fixture = random.choice(fixtures)
+        team = random.choice(fixture["teams"])
+        match_id = fixture["match_id"]
+        await recorder.request(http, "GET /api/matches/{id}", "GET", f"/api/matches/{match_id}")
+        await recorder.request(http, "GET /api/matches/{id}/events", "GET", f"/api/matches/{match_id}/events")
+        await recorder.request(http, "GET /api/teams/{id}/stats", "GET", f"/api/teams/{team['id']}/stats")
+        await recorder.request(http, "GET /api/leaderboards/goals", "GET", "/api/leaderboards/goals")
+        await recorder.request(http, "GET /api/match-events?team_id=", "GET", "/api/match-events",
+                               params={"team_id": team["id"], "event_type": "goal"})
+        await asyncio.sleep(interval)
+
+async def sample_memory(pid, samples, deadline):
+    while time.time() < deadline:
+        value = rss_mb(pid)
+        if value is not None:
+            samples.append(value)
+        await asyncio.sleep(0.5)
+
+async def run_load(args, base_url, pid):
+    recorder = Recorder()
+    ws_url = base_url.replace("http", "ws", 1)
+    limits = httpx.Limits(max_connections=args.matches + args.dashboards + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) as http:
+        fixtures = await setup_fixtures(http, recorder, args.matches)
+        setup_routes = recorder.routes()
+        recorder.latencies.clear()
+        recorder.errors.clear()
+
+        memory = [] if pid is None else [rss_mb(pid)]
+        deadline = time.time() + args.duration + 5
+        ready = asyncio.Semaphore(0)
+        spectators = [
+            asyncio.create_task(spectator(ws_url, recorder, fixture["match_id"], deadline, ready))
+            for fixture in fixtures for _ in range(args.spectators)
+        ]
+        for _ in spectators:
+            await ready.acquire()
+
+        started = time.time()
+        deadline = started + args.duration
+        workers = [live_match(http, recorder, fixture, args.event_rate, deadline) for fixture in fixtures]
+        workers += [dashboard(http, recorder, fixtures, args.poll_interval, deadline) for _ in range(args.dashboards)]
+        if pid is not None:
+            workers.append(sample_memory(pid, memory, deadline))
+        await asyncio.gather(*workers)
+        elapsed = time.time() - started
+        # Let in-flight broadcasts land before closing the sockets
+        await asyncio.sleep(1)
+        for task in spectators:
+            task.cancel()
+        await asyncio.gather(*spectators, return_exceptions=True)
+
+    memory = [value for value in memory if value is not None]
+    expected = recorder.events_sent * args.spectators
+    return {
+        "setup": setup_routes,
+        "routes": recorder.routes(),
+        "events": {
+            "sent": recorder.events_sent,
+            "per_second": round(recorder.events_sent / elapsed, 2) if elapsed else None,
+        },
+        "broadcast": {
+            "expected": expected,
+            "received": recorder.broadcasts_received,
+            "lag_ms": summarize(recorder.broadcast_lag),
+            "errors": recorder.errors.get("WS /ws", 0),
+        },
+        "memory_mb": {
+            "start": memory[0] if memory else None,
+            "peak": max(memory) if memory else None,
+            "end": memory[-1] if memory else None,
+        },
+        "duration_seconds": round(elapsed, 3),
+    }
+
+def start_server(args, db_name):
+    env = {**os.environ, "MONGO_URL": args.mongo_url, "DB_NAME": db_name, "STORAGE_BACKEND": args.storage}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", "backend",
+         "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(base_url + "/").status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("Server did not start within 30 seconds")
+
+def drop_database(mongo_url, db_name):
+    from pymongo import MongoClient
+    client = MongoClient(mongo_url)
+    client.drop_database(db_name)
+    client.close()
+
+def print_report(results):
+    print(f"{'route':40} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'errors':>7}")
+    for route, row in results["routes"].items():
+        print(f"{route:40} {row['count']:>7} {row['p50']:>9} {row['p95']:>9} {row['p99']:>9} {row['errors']:>7}")
+    events = results["events"]
+    broadcast = results["broadcast"]
+    memory = results["memory_mb"]
+    print(f"events: {events['sent']} sent, {events['per_second']}/s")
+    print(f"broadcast: {broadcast['received']}/{broadcast['expected']} delivered, "
+          f"lag p50 {broadcast['lag_ms']['p50']} ms, p99 {broadcast['lag_ms']['p99']} ms")
+    print(f"memory: start {memory['start']} MB, peak {memory['peak']} MB, end {memory['end']} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Matchday load test for the Grassroots Match Tracker API")
+    parser.add_argument("--matches", type=int, default=4, help="concurrent live matches")
+    parser.add_argument("--spectators", type=int, default=10, help="WebSocket spectators per match")
+    parser.add_argument("--dashboards", type=int, default=4, help="concurrent dashboards polling stats")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--event-rate", type=float, default=2, help="mean events per second per match")
+    parser.add_argument("--poll-interval", type=float, default=1, help="seconds between dashboard polls")
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo", help="server storage backend")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--keep-db", action="store_true", help="keep the scratch database afterwards")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    started_at = datetime.utcnow().isoformat()
+    db_name = f"grassroots_bench_{int(time.time())}"
+    process = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        process, base_url = start_server(args, db_name)
+    try:
+        results = asyncio.run(run_load(args, base_url, process.pid if process else None))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+            if args.storage == "mongo" and not args.keep_db:
+                drop_database(args.mongo_url, db_name)
+
+    results = {
+        "commit": git_commit(),
+        "started_at": started_at,
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        **results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print_report(results)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+# Tests for the in-process storage backend (backend/storage.py). It stands in
+# for Mongo, so these pin down the query, update and aggregation semantics
+# the routes rely on.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from bson import ObjectId
+from pymongo import DeleteOne, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+import storage
+from storage import MemoryDatabase, apply_update, compare, matches, upsert_seed
+
+class StorageQueryTest(unittest.TestCase):
+    def test_compare_types(self):
+        """Test that range comparisons only match values of the same BSON type"""
+        self.assertTrue(compare(5, 3, "$gt"))
+        self.assertTrue(compare(3, 3, "$gte"))
+        self.assertTrue(compare("a", "b", "$lt"))
+        self.assertTrue(compare(datetime(2024, 1, 1), datetime(2024, 1, 1), "$lte"))
+        self.assertTrue(compare(ObjectId.from_datetime(datetime(2024, 1, 1)), ObjectId(), "$lt"))
+        # Mixed types and missing fields never satisfy a range
+        self.assertFalse(compare("5", 3, "$gt"))
+        self.assertFalse(compare(None, 3, "$lt"))
+        self.assertFalse(compare(storage.MISSING, 3, "$lt"))
+        print("✅ Range comparisons follow BSON type order")
+
+    def test_matches(self):
+        """Test equality, operators, arrays, dotted paths and logical clauses"""
+        doc = {"name": "Rovers", "score": 3, "lineup": ["p1", "p2"], "venue": {"city": "Leeds"}, "note": None}
+        self.assertTrue(matches(doc, {}))
+        self.assertTrue(matches(doc, {"name": "Rovers", "venue.city": "Leeds"}))
+        self.assertTrue(matches(doc, {"lineup": "p2"}))
+        self.assertTrue(matches(doc, {"score": {"$gte": 3, "$lt": 4}}))
+        self.assertTrue(matches(doc, {"score": {"$in": [1, 3]}, "name": {"$nin": ["City"]}}))
+        self.assertTrue(matches(doc, {"name": {"$ne": "City"}}))
+        self.assertFalse(matches(doc, {"score": {"$gt": 3}}))
+        self.assertFalse(matches(doc, {"lineup": "p3"}))
+
+        # Null matches both null and missing; $exists tells them apart
+        self.assertTrue(matches(doc, {"note": None}))
+        self.assertTrue(matches(doc, {"missing": None}))
+        self.assertTrue(matches(doc, {"note": {"$exists": True}}))
+        self.assertTrue(matches(doc, {"missing": {"$exists": False}}))
+
+        self.assertTrue(matches(doc, {"$or": [{"score": 0}, {"name": "Rovers"}]}))
+        self.assertFalse(matches(doc, {"$and": [{"score": 3}, {"name": "City"}]}))
+        self.assertFalse(matches(doc, {"$nor": [{"score": 3}]}))
+        with self.assertRaises(OperationFailure):
+            matches(doc, {"score": {"$regex": "3"}})
+        print("✅ Query matching covers the operators the routes use")
+
+    def test_apply_update(self):
+        """Test each update operator against a document"""
+        doc = {"score": 1, "lineup": ["p1"], "stats": {"goals": 2}, "old": True, "best": 5}
+        apply_update(doc, {
+            "$set": {"status": "live", "stats.assists": 1},
+            "$unset": {"old": ""},
+            "$inc": {"score": 2, "stats.goals": 1, "fresh": 1},
+            "$max": {"best": 3},
+            "$min": {"best": 4},
+            "$addToSet": {"lineup": {"$each": ["p1", "p2"]}},
+            "$push": {"log": "kick-off"},
+        })
+        self.assertEqual(doc, {
+            "score": 3, "lineup": ["p1", "p2"], "stats": {"goals": 3, "assists": 1}, "best": 4,
+            "status": "live", "fresh": 1, "log": ["kick-off"],
+        })
+        apply_update(doc, {"$pull": {"lineup": "p1"}, "$setOnInsert": {"created": True}})
+        self.assertEqual(doc["lineup"], ["p2"])
+        self.assertNotIn("created", doc)
+
+        apply_update(doc, {"$setOnInsert": {"created": True}}, inserting=True)
+        self.assertTrue(doc["created"])
+        with self.assertRaises(OperationFailure):
+            apply_update(doc, {"$rename": {"score": "points"}})
+        print("✅ Update operators applied in place")
+
+    def test_upsert_seed(self):
+        """Test that an upsert starts from the filter's equality conditions"""
+        seed = upsert_seed({"player_id": "p1", "season": {"$eq": 2024}, "goals": {"$gt": 0},
+                            "team.id": "t1", "$or": [{"a": 1}]})
+        self.assertEqual(seed, {"player_id": "p1", "season": 2024, "team": {"id": "t1"}})
+        print("✅ Upserts seeded from equality conditions")
+
+class StorageCollectionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = MemoryDatabase()
+        await self.db.players.create_indexes([IndexModel([("id", 1)], unique=True)])
+
+    async def test_unique_index(self):
+        """Test that unique indexes reject duplicates on insert and update"""
+        await self.db.players.insert_one({"id": "p1"})
+        await self.db.players.insert_one({"id": "p2"})
+        with self.assertRaises(DuplicateKeyError):
+            await self.db.players.insert_one({"id": "p1"})
+        with self.assertRaises(DuplicateKeyError):
+            await self.db.players.update_one({"id": "p2"}, {"$set": {"id": "p1"}})
+        self.assertEqual(await self.db.players.count_documents({}), 2)
+        print("✅ Unique indexes enforced")
+
+    async def test_find_and_modify(self):
+        """Test cursors, projections and find_one_and_update"""
+        await self.db.players.insert_many([{"id": f"p{i}", "goals": i % 3, "team": {"id": "t1"}} for i in range(6)])
+        cursor = self.db.players.find({"goals": {"$gt": 0}}, {"_id": 0, "id": 1}).sort([("goals", -1), ("id", 1)])
+        self.assertEqual([doc["id"] for doc in await cursor.to_list(None)], ["p2", "p5", "p1", "p4"])
+        page = await self.db.players.find({}, {"_id": 0, "team": 0}).sort("id", 1).skip(1).limit(2).to_list(None)
+        self.assertEqual(page, [{"id": "p1", "goals": 1}, {"id": "p2", "goals": 2}])
+        self.assertEqual(sorted(await self.db.players.distinct("goals")), [0, 1, 2])
+
+        before = await self.db.players.find_one_and_update({"id": "p1"}, {"$inc": {"goals": 5}}, {"_id": 0, "goals": 1})
+        self.assertEqual(before, {"goals": 1})
+        after = await self.db.players.find_one_and_update({"id": "p1"}, {"$inc": {"goals": 1}}, {"_id": 0, "goals": 1},
+                                                          return_document=ReturnDocument.AFTER)
+        self.assertEqual(after, {"goals": 7})
+        created = await self.db.players.find_one_and_update({"id": "p9"}, {"$inc": {"goals": 1}}, {"_id": 0},
+                                                            upsert=True, return_document=ReturnDocument.AFTER)
+        self.assertEqual(created, {"id": "p9", "goals": 1})
+        print("✅ Cursors and find_one_and_update behave like Mongo")
+
+    async def test_bulk_write_errors(self):
+        """Test that bulk writes report failed indexes, ordered and unordered"""
+        await self.db.players.insert_one({"id": "p1", "goals": 0})
+        requests = [
+            UpdateOne({"id": "p1"}, {"$inc": {"goals": 1}}),
+            InsertOne({"id": "p1"}),
+            UpdateOne({"id": "p2"}, {"$set": {"goals": 4}}, upsert=True),
+            InsertOne({"id": "p1"}),
+        ]
+        with self.assertRaises(BulkWriteError) as raised:
+            await self.db.players.bulk_write(requests, ordered=False)
+        details = raised.exception.details
+        self.assertEqual([error["index"] for error in details["writeErrors"]], [1, 3])
+        self.assertEqual(details["writeErrors"][0]["code"], 11000)
+        self.assertEqual((details["nModified"], details["nUpserted"]), (1, 1))
+        self.assertEqual((await self.db.players.find_one({"id": "p2"}))["goals"], 4)
+
+        # Ordered writes stop at the first error
+        with self.assertRaises(BulkWriteError) as raised:
+            await self.db.players.bulk_write([InsertOne({"id": "p1"}), UpdateOne({"id": "p1"}, {"$inc": {"goals": 1}})])
+        self.assertEqual([error["index"] for error in raised.exception.details["writeErrors"]], [0])
+        self.assertEqual((await self.db.players.find_one({"id": "p1"}))["goals"], 1)
+
+        result = await self.db.players.bulk_write([
+            UpdateMany({}, {"$set": {"checked": True}}),
+            ReplaceOne({"id": "p2"}, {"id": "p2", "goals": 0}),
+            DeleteOne({"id": "p1"}),
+        ])
+        self.assertEqual((result.matched_count, result.deleted_count), (3, 1))
+        self.assertEqual(await self.db.players.find_one({"id": "p2"}, {"_id": 0}), {"id": "p2", "goals": 0})
+        print("✅ Bulk writes report per-request errors")
+
+    async def aggregate(self, collection, pipeline):
+        return await self.db[collection].aggregate(pipeline).to_list(None)
+
+    async def test_aggregation_stages(self):
+        """Test each aggregation stage the stats and leaderboard pipelines use"""
+        await self.db.matches.insert_many([
+            {"id": "m1", "home": "t1", "lineup": ["p1", "p2"]},
+            {"id": "m2", "home": "t2", "lineup": []},
+        ])
+        await self.db.events.insert_many([
+            {"match_id": "m1", "player_id": "p1", "type": "goal", "minute": 10},
+            {"match_id": "m1", "player_id": "p1", "type": "goal", "minute": 30},
+            {"match_id": "m1", "player_id": "p2", "type": "yellow_card", "minute": 50},
+            {"match_id": "m2", "player_id": "p3", "type": "goal", "minute": 5},
+        ])
+        await self.db.players.insert_many([{"id": "p1", "name": "Ann"}, {"id": "p2", "name": "Bo"}])
+
+        rows = await self.aggregate("events", [{"$match": {"type": "goal"}}, {"$sort": {"minute": -1}},
+                                               {"$skip": 1}, {"$limit": 2}, {"$project": {"_id": 0, "minute": 1}}])
+        self.assertEqual(rows, [{"minute": 10}, {"minute": 5}])
+
+        rows = await self.aggregate("events", [
+            {"$group": {
+                "_id": {"player": "$player_id", "match": "$match_id"},
+                "goals": {"$sum": {"$cond": [{"$eq": ["$type", "goal"]}, 1, 0]}},
+                "first": {"$first": "$minute"}, "last": {"$last": "$minute"},
+                "latest": {"$max": "$minute"}, "earliest": {"$min": "$minute"},
+                "types": {"$addToSet": "$type"}, "minutes": {"$push": "$minute"},
+            }},
+            {"$sort": {"_id.player": 1}},
+        ])
+        self.assertEqual(rows[0], {"_id": {"player": "p1", "match": "m1"}, "goals": 2, "first": 10, "last": 30,
+                                   "latest": 30, "earliest": 10, "types": ["goal"], "minutes": [10, 30]})
+        self.assertEqual([row["goals"] for row in rows], [2, 0, 1])
+
+        rows = await self.aggregate("matches", [
+            {"$match": {"id": "m1"}},
+            {"$unwind": "$lineup"},
+            {"$lookup": {"from": "players", "localField": "lineup", "foreignField": "id", "as": "player"}},
+            {"$unwind": "$player"},
+            {"$replaceRoot": {"newRoot": "$player"}},
+            {"$project": {"_id": 0, "name": 1, "label": {"$ifNull": ["$nickname", "$name"]}}},
+        ])
+        self.assertEqual(rows, [{"name": "Ann", "label": "Ann"}, {"name": "Bo", "label": "Bo"}])
+
+        # An empty array unwinds to nothing
+        self.assertEqual(await self.aggregate("matches", [{"$match": {"id": "m2"}}, {"$unwind": "$lineup"}]), [])
+        with self.assertRaises(OperationFailure):
+            await self.aggregate("events", [{"$bucket": {"groupBy": "$minute"}}])
+        print("✅ Aggregation stages match Mongo's results")
+
+    async def test_sqlite_write_through(self):
+        """Test that a storage path persists documents across restarts"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "store.db")
+            db = MemoryDatabase(path)
+            await db.teams.insert_one({"id": "t1", "created_at": datetime(2024, 9, 1, 10, 0)})
+            await db.teams.insert_one({"id": "t2"})
+            await db.teams.update_one({"id": "t1"}, {"$set": {"name": "Rovers"}})
+            await db.teams.delete_one({"id": "t2"})
+            db.close()
+
+            reopened = MemoryDatabase(path)
+            teams = await reopened.teams.find({}, {"_id": 0}).to_list(None)
+            reopened.close()
+        self.assertEqual(teams, [{"id": "t1", "created_at": datetime(2024, 9, 1, 10, 0), "name": "Rovers"}])
+        print("✅ SQLite write-through survives a restart")
+
+def run_tests():
+    # Create a test suite
+    suite = unittest.TestSuite()
+
+    # Add tests in specific order
+    suite.addTest(StorageQueryTest('test_compare_types'))
+    suite.addTest(StorageQueryTest('test_matches'))
+    suite.addTest(StorageQueryTest('test_apply_update'))
+    suite.addTest(StorageQueryTest('test_upsert_seed'))
+    suite.addTest(StorageCollectionTest('test_unique_index'))
+    suite.addTest(StorageCollectionTest('test_find_and_modify'))
+    suite.addTest(StorageCollectionTest('test_bulk_write_errors'))
+    suite.addTest(StorageCollectionTest('test_aggregation_stages'))
+    suite.addTest(StorageCollectionTest('test_sqlite_write_through'))
+
+    # Run the tests
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
+
+if __name__ == "__main__":
+    run_tests()
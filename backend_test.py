@@ -1,13 +1,16 @@
+import base64
 import requests
 import unittest
 import json
 import os
+import time
 from datetime import datetime, timedelta
 
 class GrassrootsMatchTrackerAPITest(unittest.TestCase):
     def setUp(self):
-        # Use the public endpoint from frontend/.env
-        self.base_url = "https://cd383368-5be3-438a-8b06-4a1311095d02.preview.emergentagent.com"
+        # Use the public endpoint from frontend/.env, or BACKEND_URL to test a
+        # local server (e.g. one started with STORAGE_BACKEND=memory)
+        self.base_url = os.getenv("BACKEND_URL", "https://cd383368-5be3-438a-8b06-4a1311095d02.preview.emergentagent.com")
         self.api_url = f"{self.base_url}/api"
         print(f"Testing API at: {self.api_url}")
         
@@ -57,6 +60,68 @@ class GrassrootsMatchTrackerAPITest(unittest.TestCase):
         print("✅ All formations validated successfully")
         return formations
         
+    def test_formations_etag_and_encoding(self):
+        """Test that formations are served with an ETag and in the negotiated encoding"""
+        response = requests.get(f"{self.api_url}/formations", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.headers.get("Vary", ""))
+        etag = response.headers["ETag"]
+        gzipped = response.json()
+        
+        response = requests.get(f"{self.api_url}/formations", headers={"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.json(), gzipped)
+        # One ETag covers every encoding of the same body
+        self.assertEqual(response.headers["ETag"], etag)
+        
+        response = requests.get(f"{self.api_url}/formations", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        
+        response = requests.get(f"{self.api_url}/formations/4-4-2")
+        self.assertEqual(response.json()["name"], "4-4-2")
+        etag = response.headers["ETag"]
+        response = requests.get(f"{self.api_url}/formations/4-4-2", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        print("✅ Formations served with ETag revalidation and gzip")
+
+    def test_custom_formation_lifecycle(self):
+        """Test creating, changing and deleting a custom formation"""
+        name = f"custom-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        positions = [{"role": "GK", "x": 50, "y": 5}]
+        etag = requests.get(f"{self.api_url}/formations").headers["ETag"]
+        
+        response = requests.post(f"{self.api_url}/formations", json={"name": name, "positions": positions})
+        self.assertEqual(response.status_code, 200)
+        response = requests.post(f"{self.api_url}/formations", json={"name": name, "positions": positions})
+        self.assertEqual(response.status_code, 409)
+        
+        # The cached list is rebuilt, so the old ETag no longer matches
+        response = requests.get(f"{self.api_url}/formations", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(name, response.json())
+        self.assertNotEqual(response.headers["ETag"], etag)
+        
+        moved = [{"role": "GK", "x": 50, "y": 10}]
+        response = requests.put(f"{self.api_url}/formations/{name}", json={"name": "ignored", "positions": moved})
+        self.assertEqual(response.status_code, 200)
+        response = requests.get(f"{self.api_url}/formations/{name}")
+        self.assertEqual((response.json()["name"], response.json()["positions"]), (name, moved))
+        
+        response = requests.delete(f"{self.api_url}/formations/{name}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(requests.get(f"{self.api_url}/formations/{name}").status_code, 404)
+        self.assertEqual(requests.delete(f"{self.api_url}/formations/{name}").status_code, 404)
+        
+        # Built-in formations can't be redefined, changed or deleted
+        builtin = {"name": "4-4-2", "positions": positions}
+        self.assertEqual(requests.post(f"{self.api_url}/formations", json=builtin).status_code, 409)
+        self.assertEqual(requests.put(f"{self.api_url}/formations/4-4-2", json=builtin).status_code, 409)
+        self.assertEqual(requests.delete(f"{self.api_url}/formations/4-4-2").status_code, 409)
+        self.assertEqual(len(requests.get(f"{self.api_url}/formations/4-4-2").json()["positions"]), 11)
+        print("✅ Custom formation created, changed and deleted with the cache rebuilt")
+
     def test_create_and_get_team(self):
         """Test creating a team and then retrieving it"""
         # Create a team
@@ -279,6 +344,313 @@ class GrassrootsMatchTrackerAPITest(unittest.TestCase):
             self.assertIsInstance(formation["positions"], list)
             print(f"✅ Retrieved formation {formation_name} with {len(formation['positions'])} positions")
 
+    def test_matches_pagination(self):
+        """Test cursor pagination and field projection on the matches list"""
+        response = requests.get(f"{self.api_url}/matches", params={"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertLessEqual(len(first_page), 1)
+        
+        next_cursor = response.headers.get("X-Next-Cursor")
+        if next_cursor:
+            response = requests.get(f"{self.api_url}/matches", params={"limit": 1, "after": next_cursor})
+            self.assertEqual(response.status_code, 200)
+            second_page = response.json()
+            self.assertEqual(len(second_page), 1)
+            self.assertNotEqual(second_page[0]["id"], first_page[0]["id"])
+            
+        # Projection returns only the requested fields plus id and the sort key
+        response = requests.get(f"{self.api_url}/matches", params={"fields": "status,venue", "limit": 5})
+        self.assertEqual(response.status_code, 200)
+        for match in response.json():
+            self.assertLessEqual(set(match.keys()), {"id", "status", "venue", "match_date"})
+            
+        # Unknown sort keys are rejected
+        response = requests.get(f"{self.api_url}/matches", params={"sort": "venue"})
+        self.assertEqual(response.status_code, 400)
+        print("✅ Match list pagination and projection working correctly")
+
+    def test_team_logo_served_from_media_endpoint(self):
+        """Test that team logos are moved out of the team document and served with ETags"""
+        # 1x1 transparent PNG
+        logo = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+        team_data = {
+            "name": f"Logo Test Team {datetime.now().strftime('%Y%m%d%H%M%S')}",
+            "logo": f"data:image/png;base64,{logo}"
+        }
+        
+        response = requests.post(f"{self.api_url}/teams", json=team_data)
+        self.assertEqual(response.status_code, 200)
+        created_team = response.json()
+        self.assertIsNone(created_team["logo"])
+        self.assertIsNotNone(created_team["logo_hash"])
+        
+        response = requests.get(f"{self.api_url}/media/{created_team['logo_hash']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertEqual(response.headers["X-Content-Type-Options"], "nosniff")
+        
+        # A matching ETag short-circuits to 304
+        response = requests.get(
+            f"{self.api_url}/media/{created_team['logo_hash']}",
+            headers={"If-None-Match": response.headers["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+        
+        # The declared type is ignored: anything that is not an image is refused
+        html = base64.b64encode(b"<script>alert(1)</script>").decode()
+        response = requests.post(f"{self.api_url}/teams", json={**team_data, "logo": f"data:image/png;base64,{html}"})
+        self.assertEqual(response.status_code, 415)
+        response = requests.post(f"{self.api_url}/media", files={"file": ("x.html", b"<script>alert(1)</script>", "text/html")})
+        self.assertEqual(response.status_code, 415)
+        print("✅ Team logo stored in media store and served with caching headers")
+
+    def test_index_report(self):
+        """Test that every route query is served by an index"""
+        response = requests.get(f"{self.api_url}/admin/index-report")
+        if response.status_code == 501:
+            self.skipTest("Query plans are only available with mongo storage")
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertIsInstance(report, list)
+        
+        collscans = [entry["route"] for entry in report if entry["collscan"]]
+        self.assertEqual(collscans, [], f"Routes falling back to a collection scan: {collscans}")
+        print(f"✅ All {len(report)} route queries use an index")
+
+    def test_bulk_match_events(self):
+        """Test posting a queue of match events in one request"""
+        match_id = f"bulk-test-match-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        event = {
+            "match_id": match_id,
+            "player_id": "bulk-test-player",
+            "team_id": "bulk-test-team",
+            "event_type": "goal",
+            "minute": 10
+        }
+        events = [event, {**event, "event_type": "yellow_card", "minute": 20}, {"minute": "not an event"}]
+        
+        response = requests.post(f"{self.api_url}/match-events/bulk", json=events)
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual([item["status"] for item in report["results"]], ["created", "created", "error"])
+        
+        response = requests.get(f"{self.api_url}/matches/{match_id}/events")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        print("✅ Bulk match event ingestion reports per-item results")
+
+    def test_idempotent_match_event(self):
+        """Test that retrying an event with the same Idempotency-Key is a no-op"""
+        key = f"idempotency-test-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        event = {
+            "match_id": f"match-{key}",
+            "player_id": f"player-{key}",
+            "team_id": f"team-{key}",
+            "event_type": "goal",
+            "minute": 42
+        }
+        
+        first = requests.post(f"{self.api_url}/match-events", json=event, headers={"Idempotency-Key": key})
+        retry = requests.post(f"{self.api_url}/match-events", json=event, headers={"Idempotency-Key": key})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(first.json()["id"], retry.json()["id"])
+        
+        # The key is scoped to the match, and reusing it for a different event is refused
+        other_match = requests.post(f"{self.api_url}/match-events",
+                                    json={**event, "match_id": f"other-{key}", "player_id": f"other-{key}"},
+                                    headers={"Idempotency-Key": key})
+        self.assertEqual(other_match.status_code, 200)
+        self.assertNotEqual(other_match.json()["id"], first.json()["id"])
+        mismatch = requests.post(f"{self.api_url}/match-events", json={**event, "minute": 43},
+                                 headers={"Idempotency-Key": key})
+        self.assertEqual(mismatch.status_code, 422)
+        
+        # Stats are updated in the background shortly after the event is stored
+        for _ in range(20):
+            response = requests.get(f"{self.api_url}/players/{event['player_id']}/stats")
+            self.assertEqual(response.status_code, 200)
+            if response.json()["goals"]:
+                break
+            time.sleep(0.1)
+        self.assertEqual(response.json()["goals"], 1)
+        print("✅ Retried match event was deduplicated")
+
+    def test_leaderboard(self):
+        """Test the top scorers leaderboard"""
+        response = requests.get(f"{self.api_url}/leaderboards/goals", params={"limit": 10})
+        self.assertEqual(response.status_code, 200)
+        rows = response.json()
+        self.assertLessEqual(len(rows), 10)
+        
+        goals = [row["goals"] for row in rows]
+        self.assertEqual(goals, sorted(goals, reverse=True))
+        for row in rows:
+            self.assertIn("player_name", row)
+            self.assertIn("rank", row)
+            
+        response = requests.get(f"{self.api_url}/leaderboards/not_a_metric")
+        self.assertEqual(response.status_code, 404)
+        print(f"✅ Top scorers leaderboard returned {len(rows)} players")
+
+    def test_patch_match_score(self):
+        """Test incrementing a score with an optimistic version check"""
+        match_data = {
+            "home_team_id": "patch-test-home",
+            "away_team_id": "patch-test-away",
+            "match_type": "Friendly",
+            "match_date": (datetime.now() + timedelta(days=1)).isoformat(),
+            "venue": "Patch Test Ground"
+        }
+        response = requests.post(f"{self.api_url}/matches", json=match_data)
+        self.assertEqual(response.status_code, 200)
+        match = response.json()
+        
+        response = requests.patch(
+            f"{self.api_url}/matches/{match['id']}/score",
+            json={"home_delta": 1, "expected_version": match["version"]}
+        )
+        self.assertEqual(response.status_code, 200)
+        updated = response.json()
+        self.assertEqual(updated["home_score"], 1)
+        self.assertEqual(updated["version"], match["version"] + 1)
+        
+        # Reusing the old version is rejected instead of overwriting
+        response = requests.patch(
+            f"{self.api_url}/matches/{match['id']}/score",
+            json={"away_delta": 1, "expected_version": match["version"]}
+        )
+        self.assertEqual(response.status_code, 409)
+        
+        # Scores never go below zero, whether set or decremented
+        for body in ({"home_delta": -2}, {"home_score": -1}):
+            response = requests.patch(f"{self.api_url}/matches/{match['id']}/score", json=body)
+            self.assertEqual(response.status_code, 422)
+        response = requests.patch(f"{self.api_url}/matches/{match['id']}/score", json={"home_delta": -1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["home_score"], 0)
+        print("✅ Match score patched with optimistic concurrency")
+
+    def test_import_squad_csv(self):
+        """Test importing a squad from CSV with a per-row report"""
+        team_id = f"csv-test-team-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        squad_csv = (
+            "name,squad_number,position,age\n"
+            "Keeper One,1,GK,24\n"
+            "Defender Two,2,DEF,\n"
+            "Clash Two,2,MID,\n"
+        )
+        
+        response = requests.post(
+            f"{self.api_url}/players/import",
+            params={"team_id": team_id},
+            files={"file": ("squad.csv", squad_csv, "text/csv")}
+        )
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual([row["status"] for row in report["rows"]], ["created", "created", "error"])
+        
+        response = requests.get(f"{self.api_url}/teams/{team_id}/players")
+        self.assertEqual(len(response.json()), 2)
+        print("✅ Squad imported from CSV with squad number clash reported")
+
+    def test_import_squad_csv_unreadable(self):
+        """Test that an unreadable squad CSV is rejected with the rows already imported"""
+        team_id = f"csv-bad-team-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        latin1_csv = "name,squad_number,position\nJosé Müller,9,FWD\n".encode("cp1252")
+        response = requests.post(
+            f"{self.api_url}/players/import",
+            params={"team_id": team_id},
+            files={"file": ("squad.csv", latin1_csv, "text/csv")}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("UTF-8", response.json()["detail"])
+        
+        # A malformed row part way through keeps the rows before it
+        rows = "".join(f"Player {number},{number},MID\n" for number in range(1, 4))
+        malformed_csv = "name,squad_number,position\n" + rows + '"' + "x" * 200000 + '",4,MID\n'
+        response = requests.post(
+            f"{self.api_url}/players/import",
+            params={"team_id": team_id},
+            files={"file": ("squad.csv", malformed_csv, "text/csv")}
+        )
+        self.assertEqual(response.status_code, 400)
+        report = response.json()
+        self.assertEqual((report["created"], report["row"]), (3, 5))
+        self.assertIn("Malformed CSV", report["detail"])
+        
+        response = requests.get(f"{self.api_url}/teams/{team_id}/players")
+        self.assertEqual(len(response.json()), 3)
+        print("✅ Unreadable squad CSV rejected with the rows already imported")
+
+    def test_query_match_events(self):
+        """Test filtering match events across matches"""
+        response = requests.get(f"{self.api_url}/match-events", params={
+            "event_type": "goal",
+            "minute_from": 0,
+            "minute_to": 90,
+            "sort": "-timestamp",
+            "limit": 5
+        })
+        self.assertEqual(response.status_code, 200)
+        events = response.json()
+        self.assertLessEqual(len(events), 5)
+        for event in events:
+            self.assertEqual(event["event_type"], "goal")
+        timestamps = [event["timestamp"] for event in events]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+        
+        # Unfiltered scans over every event are rejected
+        response = requests.get(f"{self.api_url}/match-events")
+        self.assertEqual(response.status_code, 400)
+        print(f"✅ Match event query returned {len(events)} goals")
+
+    def test_metrics_endpoint(self):
+        """Test the Prometheus metrics endpoint"""
+        requests.get(f"{self.api_url}/teams")
+        response = requests.get(f"{self.base_url}/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        body = response.text
+        self.assertIn('route="/api/teams"', body)
+        self.assertIn("http_request_duration_seconds_bucket", body)
+        # Only observed with mongo storage, but always declared
+        self.assertIn("# TYPE mongo_command_duration_seconds histogram", body)
+        self.assertIn("websocket_connections", body)
+        print("✅ Metrics endpoint exposes request, Mongo and WebSocket metrics")
+
+    def test_team_cascade_delete(self):
+        """Test that deleting a team removes its players in a background job"""
+        response = requests.post(f"{self.api_url}/teams", json={"name": f"Cascade Test {datetime.now().strftime('%Y%m%d%H%M%S%f')}"})
+        self.assertEqual(response.status_code, 200)
+        team = response.json()
+        response = requests.post(f"{self.api_url}/players", json={
+            "team_id": team["id"], "name": "Cascade Player", "squad_number": 1, "position": "GK"
+        })
+        self.assertEqual(response.status_code, 200)
+        
+        response = requests.delete(f"{self.api_url}/teams/{team['id']}")
+        self.assertEqual(response.status_code, 200)
+        job_id = response.json()["job_id"]
+        
+        for _ in range(50):
+            job = requests.get(f"{self.api_url}/admin/jobs/{job_id}").json()
+            if job["status"] in ("done", "failed"):
+                break
+            time.sleep(0.1)
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["deleted"].get("players"), 1)
+        
+        response = requests.get(f"{self.api_url}/teams/{team['id']}/players")
+        self.assertEqual(response.json(), [])
+        print(f"✅ Team cascade delete removed {job['deleted']}")
+
 def run_tests():
     # Create a test suite
     suite = unittest.TestSuite()
@@ -287,11 +659,25 @@ def run_tests():
     suite.addTest(GrassrootsMatchTrackerAPITest('test_root_endpoint'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_get_teams'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_get_formations'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_formations_etag_and_encoding'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_custom_formation_lifecycle'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_get_specific_formation'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_create_and_get_team'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_create_player_with_first_last_name'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_create_match_with_squad_selection'))
     suite.addTest(GrassrootsMatchTrackerAPITest('test_match_types'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_matches_pagination'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_team_logo_served_from_media_endpoint'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_index_report'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_bulk_match_events'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_idempotent_match_event'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_leaderboard'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_patch_match_score'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_import_squad_csv'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_import_squad_csv_unreadable'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_query_match_events'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_metrics_endpoint'))
+    suite.addTest(GrassrootsMatchTrackerAPITest('test_team_cascade_delete'))
     
     # Run the tests
     runner = unittest.TextTestRunner(verbosity=2)
@@ -0,0 +1,613 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# In-process tests for the server's own machinery. They run against the
+# memory storage backend, so no mongod or deployed API is needed.
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import server
+from storage import MemoryDatabase
+
+class FakeWebSocket:
+    def __init__(self, incoming=()):
+        self.sent = []
+        self.incoming = list(incoming)
+        self.query_params = {}
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def receive_text(self):
+        if not self.incoming:
+            raise server.WebSocketDisconnect()
+        return self.incoming.pop(0)
+
+class ServerUnitTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server.db = MemoryDatabase()
+        server.side_effects = server.EventSideEffects()
+        await server.manager.backend.start(server.manager)
+        self.live = server.LiveMatchRegistry()
+
+    async def asyncTearDown(self):
+        await self.live.stop()
+
+    async def create_live_match(self):
+        match = {"id": "m1", "home_team_id": "a", "away_team_id": "b", "status": "live",
+                 "home_score": 0, "away_score": 0, "version": 0}
+        await server.db.matches.insert_one(dict(match))
+        await server.db.match_events.insert_one({"id": "e1", "match_id": "m1", "event_type": "goal", "minute": 3})
+        return match
+
+    async def test_live_match_registry(self):
+        """Test that live match state is served and updated in memory"""
+        match = await self.create_live_match()
+        await self.live.track(match)
+        live = self.live.get("m1")
+        self.assertEqual([event["id"] for event in live.events], ["e1"])
+
+        self.live.add_events([{"id": "e2", "match_id": "m1", "event_type": "goal", "minute": 9}])
+        self.live.add_events([{"id": "e3", "match_id": "other", "event_type": "goal", "minute": 9}])
+        self.assertEqual([event["id"] for event in live.events], ["e1", "e2"])
+
+        updated = self.live.update("m1", {"$inc": {"home_score": 1, "version": 1}}, expected_version=0)
+        self.assertEqual(updated["home_score"], 1)
+        with self.assertRaises(server.HTTPException) as raised:
+            self.live.update("m1", {"$inc": {"home_score": 1, "version": 1}}, expected_version=0)
+        self.assertEqual(raised.exception.status_code, 409)
+        with self.assertRaises(server.HTTPException) as raised:
+            self.live.update("m1", {"$inc": {"away_score": -1, "version": 1}}, None, {"away_score": 1})
+        self.assertEqual(raised.exception.status_code, 422)
+
+        # Nothing reaches the database until the next flush
+        stored = await server.db.matches.find_one({"id": "m1"})
+        self.assertEqual(stored["home_score"], 0)
+        print("✅ Live match registry holds state in memory")
+
+    async def test_live_match_write_behind_flush(self):
+        """Test that the flush loop writes dirty fields back in one $set"""
+        server.LIVE_FLUSH_INTERVAL, interval = 0.01, server.LIVE_FLUSH_INTERVAL
+        self.addCleanup(setattr, server, "LIVE_FLUSH_INTERVAL", interval)
+        await self.create_live_match()
+        await self.live.start()
+        self.assertIsNotNone(self.live.get("m1"))
+
+        self.live.update("m1", {"$inc": {"home_score": 2, "version": 1}}, expected_version=None)
+        self.live.update("m1", {"$addToSet": {"home_lineup": {"$each": ["p1"]}}}, expected_version=None)
+        for _ in range(100):
+            stored = await server.db.matches.find_one({"id": "m1"})
+            if stored["home_score"] == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(stored["home_score"], 2)
+        self.assertEqual(stored["version"], 1)
+        self.assertEqual(stored["home_lineup"], ["p1"])
+        self.assertEqual(self.live.get("m1").dirty, set())
+        print("✅ Live match changes flushed behind the writes")
+
+    async def test_live_match_full_time_flush(self):
+        """Test that full time persists the match immediately and stops tracking it"""
+        match = await self.create_live_match()
+        await self.live.track(match)
+        self.live.update("m1", {"$set": {"status": "completed"}, "$inc": {"away_score": 1, "version": 1}}, None)
+        await self.live.finish("m1")
+
+        self.assertIsNone(self.live.get("m1"))
+        stored = await server.db.matches.find_one({"id": "m1"})
+        self.assertEqual((stored["status"], stored["away_score"], stored["version"]), ("completed", 1, 1))
+        print("✅ Live match flushed at full time")
+
+    def test_live_state_refused_with_shared_broadcast(self):
+        """Test that per-process live state can't be combined with a shared broadcast backend"""
+        env = {**os.environ, "STORAGE_BACKEND": "mongo", "BROADCAST_BACKEND": "mongo"}
+        command = [sys.executable, "-c", "import server; print(server.LIVE_MATCH_STATE)"]
+        result = subprocess.run(command, cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "off")
+
+        result = subprocess.run(command, cwd=BACKEND_DIR, env={**env, "LIVE_MATCH_STATE": "memory"},
+                                capture_output=True, text=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("LIVE_MATCH_STATE=memory", result.stderr)
+        print("✅ Live match state defaults to off with a shared broadcast backend")
+
+    async def test_player_stats_first_read_race(self):
+        """Test that two first reads of a player's stats don't collide on the unique index"""
+        await server.ensure_indexes()
+        stats = await server.get_player_stats("p1")
+        self.assertEqual((stats["player_id"], stats["goals"]), ("p1", 0))
+
+        # The other request created the row after this one found none
+        await server.db.player_stats.update_one({"player_id": "p2"}, {"$set": {"goals": 3}}, upsert=True)
+        collection = type(server.db.player_stats)
+        find_one = collection.find_one
+        async def missed(self, *args, **kwargs):
+            collection.find_one = find_one
+            return None
+        collection.find_one = missed
+        self.addCleanup(setattr, collection, "find_one", find_one)
+        stats = await server.get_player_stats("p2")
+        self.assertEqual(stats["goals"], 3)
+        self.assertEqual(await server.db.player_stats.count_documents({"player_id": "p2"}), 1)
+        print("✅ Concurrent first reads of player stats share one row")
+
+    async def test_rebuild_holds_stats_writes(self):
+        """Test that stats writes queued during a rebuild aren't counted twice"""
+        event = {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a", "minute": 1}
+        await server.db.match_events.insert_one(event)
+
+        # The rebuild takes the lock first, so the pending $inc for e1 waits for it
+        await server.side_effects.stats_lock.acquire()
+        rebuild = asyncio.create_task(server.rebuild_player_stats())
+        pending = asyncio.create_task(server.side_effects._write_stats([event]))
+        await asyncio.sleep(0)
+        server.side_effects.stats_lock.release()
+        await asyncio.gather(rebuild, pending)
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 1)
+
+        # Events stored after the rebuild are still counted as they arrive
+        later = {**event, "id": "e2"}
+        del later["_id"]
+        await server.db.match_events.insert_one(later)
+        await server.side_effects._write_stats([later])
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 2)
+        print("✅ Stats writes held and deduplicated during a rebuild")
+
+    async def test_stats_recounted_after_unknown_write_outcome(self):
+        """Test that a stats write that may or may not have landed is recounted, not retried"""
+        server.EVENT_RETRY_ATTEMPTS, attempts = 2, server.EVENT_RETRY_ATTEMPTS
+        self.addCleanup(setattr, server, "EVENT_RETRY_ATTEMPTS", attempts)
+        first = {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a", "minute": 1}
+        queued = {**first, "id": "e2", "minute": 2}
+        await server.db.match_events.insert_many([first, queued])
+
+        # The $inc lands but the connection drops before the reply
+        collection = type(server.db.player_stats)
+        bulk_write = collection.bulk_write
+        async def dropped(self, *args, **kwargs):
+            collection.bulk_write = bulk_write
+            await bulk_write(self, *args, **kwargs)
+            raise ConnectionError("connection reset")
+        collection.bulk_write = dropped
+        self.addCleanup(setattr, collection, "bulk_write", bulk_write)
+        await server.side_effects._write_stats([first])
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 2)
+
+        # e2 was stored before the recount, so its queued $inc is dropped;
+        # later events are counted as usual
+        await server.side_effects._write_stats([queued])
+        later = {**first, "id": "e3", "minute": 3}
+        del later["_id"]
+        await server.db.match_events.insert_one(later)
+        await server.side_effects._write_stats([later])
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 3)
+        print("✅ Stats recounted after a write with an unknown outcome")
+
+    async def test_broadcasts_not_held_by_rebuild(self):
+        """Test that match deltas still go out while a rebuild holds the stats writes"""
+        await server.side_effects.start()
+        self.addAsyncCleanup(server.side_effects.stop)
+        websocket = await self.connect_spectator(["match:m1"])
+        event = {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a", "minute": 1}
+        await server.db.match_events.insert_one(event)
+
+        await server.side_effects.stats_lock.acquire()
+        await server.side_effects.submit([event], [("m1", {"type": "event", "event": {"id": "e1"}}, [])])
+        await server.side_effects.queue.join()
+        await asyncio.sleep(0.01)
+        self.assertEqual([message["event"]["id"] for message in websocket.sent], ["e1"])
+        self.assertIsNone(await server.db.player_stats.find_one({"player_id": "p1"}))
+
+        server.side_effects.stats_lock.release()
+        await server.side_effects.held_writer
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 1)
+        print("✅ Broadcasts go out while stats writes are held")
+
+    async def test_incremental_rebuild_uses_stored_time(self):
+        """Test that an incremental rebuild picks up events with an old client timestamp"""
+        await server.rebuild_player_stats()
+        offline = {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a",
+                   "minute": 1, "timestamp": server.datetime(2020, 1, 1)}
+        await server.db.match_events.insert_one(offline)
+        result = await server.rebuild_player_stats(incremental=True)
+        self.assertEqual((result["mode"], result["updated"]), ("incremental", 1))
+        stats = await server.db.player_stats.find_one({"player_id": "p1"})
+        self.assertEqual(stats["goals"], 1)
+        print("✅ Incremental rebuild keyed on stored time")
+
+    async def test_cascade_jobs_claimed_once(self):
+        """Test that an unfinished cascade job is claimed by exactly one worker"""
+        await server.db.jobs.insert_one({"id": "j1", "kind": "player", "target_id": "p1", "status": "running",
+                                         "step": 0, "deleted": {}, "recount": []})
+        workers = [server.CascadeJobs(), server.CascadeJobs()]
+        claimed = []
+        for worker in workers:
+            worker._spawn = claimed.append
+        await asyncio.gather(*(worker.resume() for worker in workers))
+        self.assertEqual([job["id"] for job in claimed], ["j1"])
+        owner = claimed[0]["owner"]
+
+        # Still leased, so nobody else takes it
+        await asyncio.gather(*(worker.resume() for worker in workers))
+        self.assertEqual(len(claimed), 1)
+
+        # Once the lease runs out (the worker died) another worker takes over
+        # and the old owner's next progress update fails
+        await server.db.jobs.update_one({"id": "j1"}, {"$set": {"lease_expires": server.datetime(2000, 1, 1)}})
+        other = next(worker for worker in workers if worker.owner != owner)
+        await other.resume()
+        self.assertEqual(claimed[1]["owner"], other.owner)
+        previous = next(worker for worker in workers if worker.owner == owner)
+        with self.assertRaises(server.JobLeaseLost):
+            await previous._progress(claimed[0], {"$set": {"step": 1}})
+        print("✅ Cascade jobs claimed by one worker at a time")
+
+    async def test_player_removed_from_every_lineup(self):
+        """Test that a deleted player is pulled from every lineup and bench in one pass"""
+        await server.db.matches.insert_many([
+            {"id": "m1", "home_lineup": ["p1", "p2"], "away_lineup": [], "home_substitutes": [], "away_substitutes": ["p1"]},
+            {"id": "m2", "home_lineup": [], "away_lineup": ["p1"], "home_substitutes": ["p1", "p3"], "away_substitutes": []},
+            {"id": "m3", "home_lineup": ["p2"], "away_lineup": [], "home_substitutes": [], "away_substitutes": []},
+        ])
+        await server.CascadeJobs()._remove_from_lineups("p1")
+        matches = {match["id"]: match async for match in server.db.matches.find({}, {"_id": 0})}
+        self.assertEqual(matches["m1"]["home_lineup"], ["p2"])
+        self.assertEqual(matches["m1"]["away_substitutes"], [])
+        self.assertEqual(matches["m2"]["away_lineup"], [])
+        self.assertEqual(matches["m2"]["home_substitutes"], ["p3"])
+        self.assertEqual(matches["m3"]["home_lineup"], ["p2"])
+        print("✅ Deleted player removed from every lineup")
+
+    async def test_team_delete_keeps_transferred_player_stats(self):
+        """Test that deleting a team recounts, not removes, the stats of a player who moved on"""
+        await server.db.teams.insert_many([{"id": "a", "name": "A"}, {"id": "b", "name": "B"}])
+        await server.db.players.insert_many([{"id": "p1", "team_id": "a"}, {"id": "p2", "team_id": "b"}])
+        await server.db.matches.insert_many([
+            {"id": "m1", "home_team_id": "a", "away_team_id": "c"},
+            {"id": "m2", "home_team_id": "b", "away_team_id": "c"},
+        ])
+        events = [
+            {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p2", "team_id": "a", "minute": 1},
+            {"id": "e2", "match_id": "m2", "event_type": "goal", "player_id": "p2", "team_id": "b", "minute": 1},
+            {"id": "e3", "match_id": "m2", "event_type": "goal", "player_id": "p2", "team_id": "b", "minute": 2},
+            {"id": "e4", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a", "minute": 3},
+        ]
+        await server.db.match_events.insert_many(events)
+        # The stats row keeps the team of p2's first event
+        await server.db.player_stats.bulk_write(server.stat_operations(events))
+
+        jobs = server.CascadeJobs()
+        job = await jobs.submit("team", "a")
+        await jobs.tasks[job["id"]]
+        stored = await server.db.jobs.find_one({"id": job["id"]})
+        self.assertEqual(stored["status"], "done")
+        self.assertIsNone(await server.db.player_stats.find_one({"player_id": "p1"}))
+        stats = await server.db.player_stats.find_one({"player_id": "p2"})
+        self.assertEqual(stats["goals"], 2)
+
+        # A row that was already gone is rebuilt by the recount
+        await server.db.player_stats.delete_many({})
+        await server.recount_player_stats(["p2"])
+        stats = await server.db.player_stats.find_one({"player_id": "p2"})
+        self.assertEqual((stats["goals"], stats["team_id"]), (2, "b"))
+        print("✅ Team delete keeps a transferred player's stats")
+
+    def use_document_cache(self):
+        cache = server.DocumentCache(maxsize=100, ttl=60)
+        server.document_cache, previous = cache, server.document_cache
+        self.addCleanup(setattr, server, "document_cache", previous)
+        return cache
+
+    async def read(self, route, *args):
+        response = await route(*args)
+        return json.loads(response.body) if isinstance(response, server.Response) else response
+
+    async def test_document_cache_evicted_by_writes(self):
+        """Test that cached teams and players are served until a PUT or DELETE evicts them"""
+        self.use_document_cache()
+        await server.db.teams.insert_one({"id": "t1", "name": "Rovers"})
+        await server.db.players.insert_one({"id": "p1", "team_id": "t1", "name": "Keeper", "squad_number": 1,
+                                            "position": "GK"})
+        self.assertEqual((await self.read(server.get_team, "t1"))["name"], "Rovers")
+        self.assertEqual((await self.read(server.get_player, "p1"))["name"], "Keeper")
+
+        # Read through the cache: a change behind its back isn't seen...
+        await server.db.teams.update_one({"id": "t1"}, {"$set": {"name": "Behind"}})
+        self.assertEqual((await self.read(server.get_team, "t1"))["name"], "Rovers")
+
+        # ...but a write through the API evicts the entry
+        await server.update_team("t1", server.Team(id="t1", name="United"))
+        self.assertEqual((await self.read(server.get_team, "t1"))["name"], "United")
+        await server.update_player("p1", server.Player(id="p1", team_id="t1", name="Sweeper", squad_number=5,
+                                                       position="DEF"))
+        self.assertEqual((await self.read(server.get_player, "p1"))["name"], "Sweeper")
+
+        await server.delete_player("p1")
+        await server.delete_team("t1")
+        await asyncio.gather(*server.cascade_jobs.tasks.values())
+        for route, doc_id in ((server.get_player, "p1"), (server.get_team, "t1")):
+            with self.assertRaises(server.HTTPException) as raised:
+                await route(doc_id)
+            self.assertEqual(raised.exception.status_code, 404)
+        print("✅ Cached documents evicted by PUT and DELETE")
+
+    async def test_document_cache_evicted_by_events(self):
+        """Test that a stored event evicts its cached match"""
+        cache = self.use_document_cache()
+        await server.db.matches.insert_one({"id": "m1", "home_team_id": "a", "away_team_id": "b",
+                                            "status": "scheduled"})
+        await self.read(server.get_match, "m1")
+        self.assertIn("match:m1", cache.entries)
+        event = {"id": "e1", "match_id": "m1", "event_type": "goal", "player_id": "p1", "team_id": "a", "minute": 1}
+        await server.db.match_events.insert_one(event)
+        await server.side_effects.process([([event], [])])
+        self.assertNotIn("match:m1", cache.entries)
+        print("✅ Cached match evicted by an event write")
+
+    async def test_document_cache_version_check(self):
+        """Test that a write in one worker drops that kind from every other worker's cache"""
+        ours = self.use_document_cache()
+        theirs = server.DocumentCache(maxsize=100, ttl=60)
+        await server.db.teams.insert_many([{"id": "t1", "name": "Rovers"}, {"id": "t2", "name": "City"}])
+        await server.db.players.insert_one({"id": "p1", "team_id": "t1", "name": "Keeper"})
+        for cache in (ours, theirs):
+            for key, collection, doc_id in (("team:t1", "teams", "t1"), ("team:t2", "teams", "t2"),
+                                            ("player:p1", "players", "p1")):
+                await cache.get_or_load(key, lambda: server.db[collection].find_one({"id": doc_id}, {"_id": 0}))
+
+        await server.update_team("t1", server.Team(id="t1", name="United"))
+        # The writer only drops what it wrote; nobody else wrote in between
+        self.assertEqual(sorted(ours.entries), ["player:p1", "team:t2"])
+        # The other worker still has everything until its next version check...
+        self.assertEqual(sorted(theirs.entries), ["player:p1", "team:t1", "team:t2"])
+        # ...which drops every team, and only teams
+        theirs.checked_at = 0
+        team = await theirs.get_or_load("team:t1", lambda: server.db.teams.find_one({"id": "t1"}, {"_id": 0}))
+        self.assertEqual(team["name"], "United")
+        self.assertEqual(sorted(theirs.entries), ["player:p1", "team:t1"])
+        print("✅ Other workers' cached documents dropped by the version check")
+
+    async def seed_transfer(self):
+        # p1 scored 6 for a before moving to b, then 5 for b; p2 scored 10 for c
+        await server.db.players.insert_many([
+            {"id": "p1", "team_id": "b", "name": "Moved", "squad_number": 9},
+            {"id": "p2", "team_id": "c", "name": "Stayed", "squad_number": 10},
+        ])
+        kickoff = server.datetime(2024, 9, 1)
+        await server.db.matches.insert_many([
+            {"id": "m1", "home_team_id": "a", "away_team_id": "c", "match_date": kickoff, "match_type": "league"},
+            {"id": "m2", "home_team_id": "b", "away_team_id": "c", "match_date": kickoff, "match_type": "league"},
+        ])
+        goals = [("p1", "a", "m1")] * 6 + [("p1", "b", "m2")] * 5 + [("p2", "c", "m2")] * 10
+        await server.db.match_events.insert_many([
+            {"id": f"e{i}", "match_id": match_id, "event_type": "goal", "player_id": player_id,
+             "team_id": team_id, "minute": i}
+            for i, (player_id, team_id, match_id) in enumerate(goals)
+        ])
+
+    async def test_season_leaderboard_adds_up_transfers(self):
+        """Test that a league-wide season leaderboard counts a transferred player once"""
+        await self.seed_transfer()
+        rows = await server.leaderboard("goals", season=2024)
+        self.assertEqual([(row["player_id"], row["goals"], row["rank"]) for row in rows],
+                         [("p1", 11, 1), ("p2", 10, 2)])
+        self.assertEqual(rows[0]["team_id"], "b")
+
+        # A team's board only counts goals scored for that team
+        rows = await server.leaderboard("goals", team_id="a", season=2024)
+        self.assertEqual([(row["player_id"], row["team_id"], row["goals"]) for row in rows], [("p1", "a", 6)])
+        print("✅ Season leaderboard adds up a transferred player's goals")
+
+    async def test_team_stats_after_transfer(self):
+        """Test that season team stats credit each team with its own goals and share tied ranks"""
+        await self.seed_transfer()
+        await server.db.players.insert_many([
+            {"id": "p3", "team_id": "b", "name": "Partner", "squad_number": 11},
+            {"id": "p4", "team_id": "b", "name": "Sub", "squad_number": 12},
+        ])
+        await server.db.match_events.insert_many([
+            {"id": f"t{i}", "match_id": "m2", "event_type": "goal", "player_id": player_id, "team_id": "b", "minute": i}
+            for i, player_id in enumerate(["p3"] * 5 + ["p4"])
+        ])
+
+        grouped = await server.get_multi_team_stats(["a", "b"], season=2024)
+        self.assertEqual([(row["player_id"], row["goals"], row["rank"]) for row in grouped["a"]], [("p1", 6, 1)])
+        # p1 and p3 both scored 5 for b, so they share first place and p4 is third
+        self.assertEqual([(row["player_id"], row["goals"], row["rank"]) for row in grouped["b"]],
+                         [("p1", 5, 1), ("p3", 5, 1), ("p4", 1, 3)])
+        self.assertEqual({row["team_id"] for row in grouped["a"]}, {"a"})
+
+        # Ranks restart for each team
+        rows = await server.team_stats(["b", "c"], season=2024)
+        self.assertEqual([(row["team_id"], row["player_id"], row["rank"]) for row in rows],
+                         [("b", "p1", 1), ("b", "p3", 1), ("b", "p4", 3), ("c", "p2", 1)])
+        self.assertEqual(await server.get_multi_team_stats(["a"], season=2023), {"a": []})
+        print("✅ Team stats keep a transferred player's goals with each team")
+
+    async def test_leaderboard_cache_dropped_across_workers(self):
+        """Test that a stats write in one worker drops the cached leaderboards of another"""
+        await self.seed_transfer()
+        await server.rebuild_player_stats()
+        other = server.DocumentCache(maxsize=10, ttl=300, kinds={"stats": ["leaderboard:"]})
+        server.leaderboard_cache, ours = other, server.leaderboard_cache
+        self.addCleanup(setattr, server, "leaderboard_cache", ours)
+        rows = await server.get_leaderboard("goals", limit=20)
+        self.assertEqual(rows[0]["goals"], 11)
+
+        # Written through this worker's side effects while the other serves the board
+        server.leaderboard_cache = ours
+        event = {"id": "e99", "match_id": "m2", "event_type": "goal", "player_id": "p2", "team_id": "c", "minute": 90}
+        await server.db.match_events.insert_one(event)
+        await server.side_effects._write_stats([event])
+        server.leaderboard_cache = other
+        other.checked_at = 0
+        rows = await server.get_leaderboard("goals", limit=20)
+        self.assertEqual([(row["player_id"], row["goals"]) for row in rows], [("p1", 11), ("p2", 11)])
+        print("✅ Leaderboards dropped in every worker after a stats write")
+
+    async def connect_spectator(self, topics):
+        websocket = FakeWebSocket()
+        await server.manager.connect(websocket, topics)
+        self.addAsyncCleanup(self.disconnect_spectator, websocket)
+        return websocket
+
+    async def disconnect_spectator(self, websocket):
+        server.manager.disconnect(websocket)
+        await asyncio.sleep(0)
+
+    async def publish_deltas(self, match_id, count):
+        server.match_sequencer.buffers.pop(match_id, None)
+        for minute in range(count):
+            await server.publish_match_delta(match_id, {"type": "event", "event": {"minute": minute}}, [])
+
+    async def test_websocket_replay_from_buffer(self):
+        """Test that a reconnecting spectator gets exactly the deltas after its seq"""
+        await self.publish_deltas("m1", 5)
+        websocket = await self.connect_spectator(["match:m1"])
+        await server.replay_since(websocket, ["match:m1"], 2)
+        await asyncio.sleep(0.01)
+        self.assertEqual([message["seq"] for message in websocket.sent], [3, 4, 5])
+        self.assertEqual([message["event"]["minute"] for message in websocket.sent], [2, 3, 4])
+        print("✅ Missed deltas replayed from the ring buffer")
+
+    async def test_websocket_replay_snapshot_fallback(self):
+        """Test that a spectator too far behind the buffer gets a snapshot instead"""
+        await server.db.matches.insert_one({"id": "m1", "status": "live", "home_score": 1,
+                                            "match_date": server.datetime(2024, 9, 1, 10, 30)})
+        await server.db.match_events.insert_one({"id": "e1", "match_id": "m1", "event_type": "goal", "minute": 7,
+                                                 "timestamp": server.datetime(2024, 9, 1, 10, 37, 5)})
+        await self.publish_deltas("m1", 3)
+        server.match_sequencer.buffers.pop("m1")
+        websocket = await self.connect_spectator(["match:m1"])
+        await server.replay_since(websocket, ["match:m1"], 1)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(len(websocket.sent), 1)
+        snapshot = websocket.sent[0]
+        self.assertEqual((snapshot["type"], snapshot["seq"]), ("snapshot", 3))
+        self.assertEqual(snapshot["match"]["home_score"], 1)
+        # Encoded like every other message, so dates are ISO 8601
+        self.assertEqual(snapshot["match"]["match_date"], "2024-09-01T10:30:00")
+        self.assertEqual(snapshot["events"][0]["timestamp"], "2024-09-01T10:37:05")
+        print("✅ Snapshot sent when the ring buffer can't cover the gap")
+
+    async def test_websocket_replay_longer_than_queue(self):
+        """Test that a replay that wouldn't fit in the send queue becomes a snapshot"""
+        await server.db.matches.insert_one({"id": "m1", "status": "live", "home_score": 0})
+        await self.publish_deltas("m1", server.WS_SEND_QUEUE_SIZE + 50)
+        websocket = await self.connect_spectator(["match:m1"])
+        await server.replay_since(websocket, ["match:m1"], 0)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(websocket.sent), 1)
+        self.assertEqual((websocket.sent[0]["type"], websocket.sent[0]["seq"]),
+                         ("snapshot", server.WS_SEND_QUEUE_SIZE + 50))
+        self.assertIn(websocket, server.manager.active_connections)
+        print("✅ Snapshot sent when the replay wouldn't fit in the send queue")
+
+    async def export_import(self, compress):
+        created = server.datetime(2024, 9, 1, 10, 30)
+        await server.db.teams.insert_one({"id": "t1", "name": "Rovers", "created_at": created})
+        await server.db.players.insert_many([{"id": f"p{i}", "team_id": "t1", "name": f"Player {i}",
+                                              "squad_number": i} for i in range(3)])
+        await server.db.match_events.insert_one({"id": "e1", "match_id": "m1", "player_id": "p1", "minute": 9,
+                                                 "additional_data": {"assist": "p2"}, "timestamp": created})
+        await server.db.media.insert_one({"hash": "abc", "data": b"\x89PNG", "content_type": "image/png"})
+        exported = {name: await server.db[name].find({}, {"_id": 0}).to_list(None)
+                    for name in server.EXPORT_COLLECTIONS}
+
+        chunks = server.export_lines(server.parse_collections(None))
+        if compress:
+            chunks = server.gzip_stream(chunks)
+        data = b"".join([chunk async for chunk in chunks])
+        self.assertEqual(data[:2] == b"\x1f\x8b", compress)
+
+        async def trickle():
+            # One byte at a time, so the format check sees a split header
+            for index in range(len(data)):
+                yield data[index:index + 1]
+
+        server.db = MemoryDatabase()
+        result = await server.import_lines(server.ndjson_lines(trickle()))
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(result["lines"], 6)
+        imported = {name: await server.db[name].find({}, {"_id": 0}).to_list(None)
+                    for name in server.EXPORT_COLLECTIONS}
+        self.assertEqual(imported, exported)
+
+    async def test_export_import_round_trip(self):
+        """Test that an NDJSON export imports back unchanged"""
+        await self.export_import(compress=False)
+        print("✅ Plain export round-trips through import")
+
+    async def test_export_import_round_trip_gzip(self):
+        """Test that a gzip export imports back unchanged"""
+        await self.export_import(compress=True)
+        print("✅ Gzip export round-trips through import")
+
+    async def test_websocket_command_after_drop(self):
+        """Test that a command from a socket dropped as too slow ends the handler quietly"""
+        websocket = FakeWebSocket([json.dumps({"action": "subscribe", "topics": ["match:m1"]})])
+        connect = server.manager.connect
+
+        async def connect_then_drop(socket, topics):
+            connection = await connect(socket, topics)
+            server.manager.disconnect(socket)
+            return connection
+
+        server.manager.connect = connect_then_drop
+        self.addCleanup(setattr, server.manager, "connect", connect)
+        await server.websocket_endpoint(websocket)
+        self.assertNotIn(websocket, server.manager.active_connections)
+        self.assertNotIn("match:m1", server.manager.subscribers)
+        print("✅ Commands from a dropped socket are ignored")
+
+def run_tests():
+    # Create a test suite
+    suite = unittest.TestSuite()
+
+    # Add tests in specific order
+    suite.addTest(ServerUnitTest('test_live_match_registry'))
+    suite.addTest(ServerUnitTest('test_live_match_write_behind_flush'))
+    suite.addTest(ServerUnitTest('test_live_match_full_time_flush'))
+    suite.addTest(ServerUnitTest('test_live_state_refused_with_shared_broadcast'))
+    suite.addTest(ServerUnitTest('test_player_stats_first_read_race'))
+    suite.addTest(ServerUnitTest('test_rebuild_holds_stats_writes'))
+    suite.addTest(ServerUnitTest('test_stats_recounted_after_unknown_write_outcome'))
+    suite.addTest(ServerUnitTest('test_broadcasts_not_held_by_rebuild'))
+    suite.addTest(ServerUnitTest('test_incremental_rebuild_uses_stored_time'))
+    suite.addTest(ServerUnitTest('test_cascade_jobs_claimed_once'))
+    suite.addTest(ServerUnitTest('test_player_removed_from_every_lineup'))
+    suite.addTest(ServerUnitTest('test_team_delete_keeps_transferred_player_stats'))
+    suite.addTest(ServerUnitTest('test_document_cache_evicted_by_writes'))
+    suite.addTest(ServerUnitTest('test_document_cache_evicted_by_events'))
+    suite.addTest(ServerUnitTest('test_document_cache_version_check'))
+    suite.addTest(ServerUnitTest('test_season_leaderboard_adds_up_transfers'))
+    suite.addTest(ServerUnitTest('test_team_stats_after_transfer'))
+    suite.addTest(ServerUnitTest('test_leaderboard_cache_dropped_across_workers'))
+    suite.addTest(ServerUnitTest('test_websocket_replay_from_buffer'))
+    suite.addTest(ServerUnitTest('test_websocket_replay_snapshot_fallback'))
+    suite.addTest(ServerUnitTest('test_websocket_replay_longer_than_queue'))
+    suite.addTest(ServerUnitTest('test_export_import_round_trip'))
+    suite.addTest(ServerUnitTest('test_export_import_round_trip_gzip'))
+    suite.addTest(ServerUnitTest('test_websocket_command_after_drop'))
+
+    # Run the tests
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
+
+if __name__ == "__main__":
+    run_tests()